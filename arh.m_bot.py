@@ -1,9 +1,19 @@
 import json
+import asyncio
+import calendar
+import heapq
+import itertools
 import logging
 import re
 import os
-from datetime import datetime, timedelta
+import sqlite3
+import random
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta
 from typing import Dict, List, Tuple, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from telegram import (
     Update, 
@@ -15,6 +25,8 @@ from telegram import (
 )
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
+    TypeHandler,
     ContextTypes,
     CommandHandler,
     MessageHandler,
@@ -23,6 +35,10 @@ from telegram.ext import (
     ChatMemberHandler
 )
 from telegram.constants import ParseMode, ChatMemberStatus
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import bot_metrics
+import bot_webhook
 
 # Настройка логирования
 logging.basicConfig(
@@ -34,28 +50,645 @@ logger = logging.getLogger(__name__)
 BIRTHDAYS_FILE = "birthdays.json"
 WISHLISTS_FILE = "wishlists.json"
 ADMIN_USERNAME = "mr_jasp"  # Администратор бота
+# Запрещённые слова, по одному на строку (# — комментарий). Файл перечитывается при изменении,
+# без перезапуска бота; пока его нет, действует DEFAULT_CENSOR_WORDS
+CENSOR_FILE = "censor_words.txt"
+CENSOR_CHECK_INTERVAL = 5.0  # Секунды между проверками времени изменения файла
+DEFAULT_CENSOR_WORDS = ["мат1", "мат2", "оскорбление"]  # Замените на реальные плохие слова
+METRICS_PORT = None  # Локальный порт для метрик Prometheus (/metrics); None — не запускать
+WRITE_DELAY = 2.0  # Секунды от изменения данных до записи на диск; изменения за это время пишутся разом
+# Хранилище: "sqlite" (при первом запуске переносит данные из JSON-файлов) или "json"
+STORAGE_BACKEND = "sqlite"
+SQLITE_DB = "arh_m.sqlite3"
+DELIVERIES_FILE = "deliveries.json"  # Отправленные напоминания для хранилища "json"
+META_FILE = "meta.json"  # Служебные значения (дата последней рассылки) для хранилища "json"
+SETTINGS_FILE = "reminder_settings.json"  # Время и часовой пояс напоминаний чатов для хранилища "json"
+DELIVERY_RETENTION_DAYS = 60  # Сколько дней помнить отправленные напоминания
+
+# Напоминания о днях рождения
+# Время и часовой пояс по умолчанию; пользователь выбирает свои в ЛС через /set_reminder_time.
+# None — часовой пояс сервера
+REMINDER_TIME = "13:00"
+REMINDER_TIMEZONE = None
+REMINDER_LEAD_DAYS = (0, 14)  # За сколько дней напоминать; 0 — поздравление в сам день
+REMINDER_CATCHUP_DAYS = 7  # За сколько пропущенных дней (бот не работал) догонять напоминания при запуске
+SCHEDULER_IDLE = 3600  # Секунды; планировщик просыпается не реже, чтобы запланировать наступившие дни
+
+# Рассылка напоминаний: общий лимит Telegram ~30 сообщений/с, в один чат — ~1 сообщение/с
+FANOUT_GLOBAL_RATE = 25.0
+FANOUT_CHAT_RATE = 1.0
+FANOUT_CONCURRENCY = 20
+SEND_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0  # Секунды; удваивается с каждой попыткой
+
+# Кэш имён пользователей для /birthdays: заполняется из входящих обновлений, остальные
+# запрашиваются через get_chat не больше PROFILE_LOOKUP_CONCURRENCY одновременно
+PROFILE_TTL = 7 * 86400  # Секунды; устаревшее имя показывается сразу и обновляется в фоне
+PROFILE_MISS_TTL = 3600  # Сколько не повторять get_chat для пользователя, которого не удалось найти
+PROFILE_LOOKUP_CONCURRENCY = 8
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+
+CONCURRENT_UPDATES = 16  # Одновременно обрабатываемых обновлений при run_polling; 1 — по одному
+
+# Режим webhook: порт локального сервера; None — получать обновления через run_polling
+WEBHOOK_PORT = None
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_URL = None  # Публичный адрес для set_webhook; None — webhook настроен снаружи
+# Секрет в заголовке запросов Telegram. None — случайный на каждый запуск (пишется в лог);
+# без WEBHOOK_URL обязателен, иначе бот не запустится
+WEBHOOK_SECRET = None
+# Обновления разных пользователей обрабатываются параллельно, одного пользователя — по очереди
+WEBHOOK_CONCURRENT_UPDATES = 16
+ALLOWED_UPDATES = Update.ALL_TYPES
+
+def _stage(name: str, **labels):
+    return bot_metrics.timed(bot_metrics.STAGE_SECONDS, bot="arh_m", stage=name, **labels)
+
+def _event(name: str, amount: int = 1):
+    bot_metrics.inc(bot_metrics.EVENTS, amount, bot="arh_m", event=name)
 
 # Загрузка данных из JSON
 def load_data(filename: str) -> Dict:
+    with _stage("load_data", file=filename):
+        try:
+            if os.path.exists(filename):
+                with open(filename, "r") as f:
+                    return json.load(f)
+            return {}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+# Атомарная запись: временный файл в том же каталоге и переименование поверх старого
+def _write_atomic(text: str, filename: str):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
     try:
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                return json.load(f)
-        return {}
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    # Переименование сохраняется на диске вместе с каталогом (где это поддерживается)
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 # Сохранение данных в JSON
 def save_data(data: Dict, filename: str):
-    with open(filename, "w") as f:
-        json.dump(data, f, indent=4)
+    with _stage("save_data", file=filename):
+        _write_atomic(json.dumps(data, indent=4), filename)
+
+# Данные JSON-файла в памяти процесса: читаются один раз, изменения пишутся на диск через
+# WRITE_DELAY секунд одной атомарной записью. Обработчики меняют data и вызывают mark_dirty()
+class JsonStore:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._data: Optional[Dict] = None
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def data(self) -> Dict:
+        if self._data is None:
+            self._data = load_data(self.filename)
+        return self._data
+
+    def mark_dirty(self):
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий (скрипты, миграции) пишем сразу
+            save_data(self.data, self.filename)
+            self._dirty = False
+            return
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(WRITE_DELAY)
+        # Изменения во время записи запланируют следующую
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            with _stage("save_data", file=self.filename):
+                # Снимок сериализуется в цикле событий, пока обработчики не могут менять данные
+                text = json.dumps(self._data, indent=4)
+                try:
+                    await asyncio.to_thread(_write_atomic, text, self.filename)
+                except OSError as e:
+                    self._dirty = True
+                    logger.error(f"Ошибка записи {self.filename}: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+def _month_day(date: str) -> Tuple[int, int]:
+    day, month = map(int, date.split('.'))
+    return month, day
+
+# Операции хранилища, которые нужны обработчикам. Даты хранятся строками "ДД.ММ",
+# id пользователей — строками, как в исходных JSON-файлах. Каждая операция — один синхронный
+# вызов в цикле событий без await внутри: чтение-изменение-запись не прерывается параллельными
+# обработчиками, и хранилище остаётся единственным писателем своих файлов
+class Storage(ABC):
+    def load(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    def get_birthday(self, user_id: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set_birthday(self, user_id: str, date: str):
+        pass
+
+    # Все дни рождения [(user_id, "ДД.ММ")] в порядке календаря
+    @abstractmethod
+    def birthdays(self) -> List[Tuple[str, str]]:
+        pass
+
+    # Выборка по индексу дня года, без прохода по всем пользователям
+    @abstractmethod
+    def birthdays_on(self, month: int, day: int) -> List[str]:
+        pass
+
+    @abstractmethod
+    def get_wishlist(self, user_id: str) -> List[str]:
+        pass
+
+    @abstractmethod
+    def add_wishlist_item(self, user_id: str, text: str):
+        pass
+
+    # Wish-лист после изменения; None — позиции с таким номером нет
+    @abstractmethod
+    def update_wishlist_item(self, user_id: str, index: int, text: str) -> Optional[List[str]]:
+        pass
+
+    # False — wish-листа не было
+    @abstractmethod
+    def delete_wishlist(self, user_id: str) -> bool:
+        pass
+
+    # Кто из user_ids ведёт непустой wish-лист
+    @abstractmethod
+    def wishlist_owners(self, user_ids: List[str]) -> set:
+        pass
+
+    # Отправленные напоминания: ключ включает дату и вид, повторный запуск их не дублирует
+    @abstractmethod
+    def is_delivered(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def mark_delivered(self, key: str, chat_id: str):
+        pass
+
+    @abstractmethod
+    def prune_deliveries(self, before: float):
+        pass
+
+    @abstractmethod
+    def get_meta(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set_meta(self, key: str, value: str):
+        pass
+
+    # Время "ЧЧ:ММ" и часовой пояс (None — по умолчанию) напоминаний в чат; None — не настроено
+    @abstractmethod
+    def get_reminder_settings(self, chat_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        pass
+
+    @abstractmethod
+    def set_reminder_settings(self, chat_id: str, time: str, timezone: Optional[str]):
+        pass
+
+# Исходные JSON-файлы в памяти с отложенной записью. Выборка по дате — по индексу (месяц, день),
+# который строится при первом обращении и обновляется в set_birthday
+class JsonStorage(Storage):
+    def __init__(self, birthdays_file: str = BIRTHDAYS_FILE, wishlists_file: str = WISHLISTS_FILE,
+                 deliveries_file: str = DELIVERIES_FILE, meta_file: str = META_FILE,
+                 settings_file: str = SETTINGS_FILE):
+        self.birthdays_store = JsonStore(birthdays_file)
+        self.wishlists_store = JsonStore(wishlists_file)
+        self.deliveries_store = JsonStore(deliveries_file)
+        self.meta_store = JsonStore(meta_file)
+        self.settings_store = JsonStore(settings_file)
+        self._by_day: Optional[Dict[Tuple[int, int], set]] = None
+
+    def load(self):
+        self.birthdays_store.data
+        self.wishlists_store.data
+        self.deliveries_store.data
+        self.meta_store.data
+        self.settings_store.data
+        self._day_index()
+
+    async def close(self):
+        for store in (self.birthdays_store, self.wishlists_store, self.deliveries_store, self.meta_store,
+                      self.settings_store):
+            await store.close()
+
+    def _day_index(self) -> Dict[Tuple[int, int], set]:
+        if self._by_day is None:
+            self._by_day = {}
+            for uid, date in self.birthdays_store.data.items():
+                if is_valid_date(date):
+                    self._by_day.setdefault(_month_day(date), set()).add(uid)
+        return self._by_day
+
+    def get_birthday(self, user_id):
+        return self.birthdays_store.data.get(user_id)
+
+    def set_birthday(self, user_id, date):
+        by_day = self._day_index()
+        old = self.birthdays_store.data.get(user_id)
+        if old is not None and is_valid_date(old):
+            by_day.get(_month_day(old), set()).discard(user_id)
+        by_day.setdefault(_month_day(date), set()).add(user_id)
+        self.birthdays_store.data[user_id] = date
+        self.birthdays_store.mark_dirty()
+
+    def birthdays(self):
+        # Некорректные даты из старых файлов — в конце списка
+        return sorted(
+            self.birthdays_store.data.items(),
+            key=lambda item: _month_day(item[1]) if is_valid_date(item[1]) else (13, 0)
+        )
+
+    def birthdays_on(self, month, day):
+        return sorted(self._day_index().get((month, day), ()))
+
+    def get_wishlist(self, user_id):
+        return list(self.wishlists_store.data.get(user_id, []))
+
+    def add_wishlist_item(self, user_id, text):
+        self.wishlists_store.data.setdefault(user_id, []).append(text)
+        self.wishlists_store.mark_dirty()
+
+    def update_wishlist_item(self, user_id, index, text):
+        items = self.wishlists_store.data.get(user_id, [])
+        if not 0 <= index < len(items):
+            return None
+        items[index] = text
+        self.wishlists_store.mark_dirty()
+        return list(items)
+
+    def delete_wishlist(self, user_id):
+        if user_id not in self.wishlists_store.data:
+            return False
+        del self.wishlists_store.data[user_id]
+        self.wishlists_store.mark_dirty()
+        return True
+
+    def wishlist_owners(self, user_ids):
+        wishlists = self.wishlists_store.data
+        return {uid for uid in user_ids if wishlists.get(uid)}
+
+    # Отметка попадает на диск с отложенной записью: при аварии в течение WRITE_DELAY
+    # напоминание может уйти повторно
+    def is_delivered(self, key):
+        return key in self.deliveries_store.data
+
+    def mark_delivered(self, key, chat_id):
+        self.deliveries_store.data[key] = [chat_id, time.time()]
+        self.deliveries_store.mark_dirty()
+
+    def prune_deliveries(self, before):
+        deliveries = self.deliveries_store.data
+        expired = [key for key, (_, delivered) in deliveries.items() if delivered < before]
+        for key in expired:
+            del deliveries[key]
+        if expired:
+            self.deliveries_store.mark_dirty()
+
+    def get_meta(self, key):
+        return self.meta_store.data.get(key)
+
+    def set_meta(self, key, value):
+        self.meta_store.data[key] = value
+        self.meta_store.mark_dirty()
+
+    def get_reminder_settings(self, chat_id):
+        settings = self.settings_store.data.get(chat_id)
+        return tuple(settings) if settings else None
+
+    def set_reminder_settings(self, chat_id, time, timezone):
+        self.settings_store.data[chat_id] = [time, timezone]
+        self.settings_store.mark_dirty()
+
+# SQLite: дни рождения с индексом по (месяц, день), позиции wish-листов отдельными строками.
+# Каждое изменение — одна короткая транзакция по индексу, без перезаписи остальных данных
+class SqliteStorage(Storage):
+    def __init__(self, path: str = SQLITE_DB, birthdays_file: str = BIRTHDAYS_FILE,
+                 wishlists_file: str = WISHLISTS_FILE):
+        self.path = path
+        self.birthdays_file = birthdays_file
+        self.wishlists_file = wishlists_file
+        self.db: Optional[sqlite3.Connection] = None
+
+    def load(self):
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS birthdays (
+                user_id TEXT PRIMARY KEY,
+                date TEXT NOT NULL,
+                month INTEGER NOT NULL,
+                day INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS birthdays_month_day ON birthdays (month, day);
+            CREATE TABLE IF NOT EXISTS wishlist_items (
+                user_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (user_id, position)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS deliveries (
+                key TEXT PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                delivered REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS deliveries_delivered ON deliveries (delivered);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reminder_settings (
+                chat_id TEXT PRIMARY KEY,
+                time TEXT NOT NULL,
+                timezone TEXT
+            );
+            """
+        )
+        self.migrate_json()
+
+    # Однократный перенос birthdays.json и wishlists.json; JSON-файлы не изменяются
+    def migrate_json(self):
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        birthdays = load_data(self.birthdays_file)
+        wishlists = load_data(self.wishlists_file)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO birthdays (user_id, date, month, day) VALUES (?, ?, ?, ?)",
+                [
+                    (uid, date, *_month_day(date))
+                    for uid, date in birthdays.items() if is_valid_date(date)
+                ]
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO wishlist_items (user_id, position, text) VALUES (?, ?, ?)",
+                [(uid, position, text) for uid, items in wishlists.items() for position, text in enumerate(items)]
+            )
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+        logger.info(f"Перенесено из JSON: {len(birthdays)} дней рождения, {len(wishlists)} wish-листов")
+
+    async def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def get_birthday(self, user_id):
+        row = self.db.execute("SELECT date FROM birthdays WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_birthday(self, user_id, date):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO birthdays (user_id, date, month, day) VALUES (?, ?, ?, ?)",
+                (user_id, date, *_month_day(date))
+            )
+
+    def birthdays(self):
+        return self.db.execute("SELECT user_id, date FROM birthdays ORDER BY month, day").fetchall()
+
+    def birthdays_on(self, month, day):
+        rows = self.db.execute("SELECT user_id FROM birthdays WHERE month = ? AND day = ?", (month, day))
+        return [row[0] for row in rows]
+
+    def get_wishlist(self, user_id):
+        rows = self.db.execute("SELECT text FROM wishlist_items WHERE user_id = ? ORDER BY position", (user_id,))
+        return [row[0] for row in rows]
+
+    def add_wishlist_item(self, user_id, text):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO wishlist_items (user_id, position, text) "
+                "SELECT ?, COALESCE(MAX(position) + 1, 0), ? FROM wishlist_items WHERE user_id = ?",
+                (user_id, text, user_id)
+            )
+
+    def update_wishlist_item(self, user_id, index, text):
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE wishlist_items SET text = ? WHERE user_id = ? AND position = ?", (text, user_id, index)
+            )
+            if cursor.rowcount == 0:
+                return None
+            rows = self.db.execute("SELECT text FROM wishlist_items WHERE user_id = ? ORDER BY position", (user_id,))
+            return [row[0] for row in rows]
+
+    def delete_wishlist(self, user_id):
+        with self.db:
+            cursor = self.db.execute("DELETE FROM wishlist_items WHERE user_id = ?", (user_id,))
+        return cursor.rowcount > 0
+
+    def wishlist_owners(self, user_ids):
+        owners = set()
+        # Ограничение SQLite на число параметров запроса
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT DISTINCT user_id FROM wishlist_items WHERE user_id IN ({placeholders})", chunk
+            )
+            owners.update(row[0] for row in rows)
+        return owners
+
+    def is_delivered(self, key):
+        return self.db.execute("SELECT 1 FROM deliveries WHERE key = ?", (key,)).fetchone() is not None
+
+    def mark_delivered(self, key, chat_id):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO deliveries (key, chat_id, delivered) VALUES (?, ?, ?)",
+                (key, chat_id, time.time())
+            )
+
+    def prune_deliveries(self, before):
+        with self.db:
+            self.db.execute("DELETE FROM deliveries WHERE delivered < ?", (before,))
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_reminder_settings(self, chat_id):
+        return self.db.execute(
+            "SELECT time, timezone FROM reminder_settings WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+
+    def set_reminder_settings(self, chat_id, time, timezone):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO reminder_settings (chat_id, time, timezone) VALUES (?, ?, ?)",
+                (chat_id, time, timezone)
+            )
+
+storage: Storage = SqliteStorage() if STORAGE_BACKEND == "sqlite" else JsonStorage()
+
+# Данные открываются один раз при запуске, а не в первом обработчике
+async def load_storage(application: Application):
+    storage.load()
+
+# Запись отложенных изменений и закрытие хранилища при остановке бота
+async def close_storage(application: Application):
+    await storage.close()
+
+async def on_startup(application: Application):
+    await load_storage(application)
+    start_reminders(application)
+
+async def on_shutdown(application: Application):
+    await stop_reminders()
+    await close_storage(application)
+
+# ====================== Цензура ======================
+
+# Латинские буквы, похожие на кириллические, и ё: текст и слова списка приводятся к одному виду
+LOOKALIKES = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е",
+})
+
+# Нижний регистр и замена похожих букв с сохранением позиций символов
+def _fold(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Редкие символы, которые в нижнем регистре длиннее (İ): посимвольно, без них
+        lowered = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+    return lowered.translate(LOOKALIKES)
+
+# Регулярное выражение по префиксному дереву слов: на каждой позиции текста проверяется одна
+# ветка на первую букву, а не весь список, поэтому время почти не зависит от длины списка
+def _trie_pattern(node: Dict) -> str:
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        # Здесь заканчивается более короткое слово; сначала пробуется длинное
+        pattern = "(?:" + pattern + ")?"
+    return pattern
+
+def compile_censor(words: List[str]) -> Optional[re.Pattern]:
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for char in _fold(word.strip()):
+            node = node.setdefault(char, {})
+        if node is not trie:
+            node[""] = {}
+    return re.compile(_trie_pattern(trie)) if trie else None
+
+# Список запрещённых слов, собранный в одно выражение. Файл проверяется не чаще раза
+# в CENSOR_CHECK_INTERVAL секунд и перекомпилируется, когда меняется время изменения или размер
+class Censor:
+    def __init__(self, path: Optional[str] = CENSOR_FILE, default: List[str] = DEFAULT_CENSOR_WORDS,
+                 check_interval: float = CENSOR_CHECK_INTERVAL, clock=time.monotonic):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        self.clock = clock
+        self.signature = None  # (mtime_ns, size) загруженного файла
+        self.checked = None
+        self.words = 0
+        self.pattern: Optional[re.Pattern] = None
+
+    def _load(self, words: List[str]):
+        started = time.perf_counter()
+        self.pattern = compile_censor(words)
+        self.words = len(words)
+        bot_metrics.observe(bot_metrics.STAGE_SECONDS, time.perf_counter() - started, bot="arh_m", stage="censor_compile")
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path) if self.path else None
+        except OSError:
+            stat = None
+        signature = (stat.st_mtime_ns, stat.st_size) if stat else None
+        if signature == self.signature and self.pattern is not None:
+            return
+        if stat is None:
+            self._load(self.default)
+        else:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    words = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+            except (OSError, UnicodeDecodeError) as e:
+                # Файл меняется прямо сейчас или испорчен: остаётся прежний список
+                logger.error(f"Ошибка чтения {self.path}: {e}")
+                return
+            self._load(words)
+            logger.info(f"Загружено запрещённых слов: {self.words} ({self.path})")
+            _event("censor_reload")
+        self.signature = signature
+
+    def censor(self, text: str) -> str:
+        now = self.clock()
+        if self.checked is None or now - self.checked >= self.check_interval:
+            self.checked = now
+            self.reload()
+        if self.pattern is None:
+            return text
+        folded = _fold(text)
+        spans = [match.span() for match in self.pattern.finditer(folded) if match.end() > match.start()]
+        if not spans:
+            return text
+        parts = []
+        position = 0
+        for start, end in spans:
+            parts.append(text[position:start])
+            parts.append("***")
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+
+censor = Censor()
 
 # Цензура текста
 def censor_text(text: str) -> str:
-    forbidden_words = ["мат1", "мат2", "оскорбление"]  # Замените на реальные плохие слова
-    for word in forbidden_words:
-        text = re.sub(re.escape(word), "***", text, flags=re.IGNORECASE)
-    return text
+    return censor.censor(text)
 
 # Проверка формата даты
 def is_valid_date(date_str: str) -> bool:
@@ -118,7 +751,7 @@ async def setup_commands(application: Application):
         BotCommand("delete_wishlist", "Удалить wish-лист"),
         BotCommand("birthdays", "Все дни рождения"),
         BotCommand("add_birthday", "Добавить ДР (админ)"),
-        BotCommand("set_reminder_time", "Настройка времени (админ)"),
+        BotCommand("set_reminder_time", "Время напоминаний (в ЛС)"),
     ]
     await application.bot.set_my_commands(commands)
 
@@ -126,9 +759,9 @@ async def setup_commands(application: Application):
 
 async def show_wishlist_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    wishlists = load_data(WISHLISTS_FILE)
+    wishlist = storage.get_wishlist(user_id)
     
-    if user_id not in wishlists or not wishlists[user_id]:
+    if not wishlist:
         keyboard = [
             [InlineKeyboardButton("Создать wish-лист", callback_data="create_wishlist")]
         ]
@@ -138,7 +771,7 @@ async def show_wishlist_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     else:
         items = "\n".join(
-            [f"{i+1}. {item}" for i, item in enumerate(wishlists[user_id])]
+            [f"{i+1}. {item}" for i, item in enumerate(wishlist)]
         )
         keyboard = [
             [InlineKeyboardButton("Обновить wish-лист", callback_data="update_wishlist")],
@@ -159,13 +792,7 @@ async def add_wishlist_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     text = censor_text(update.message.text.strip())
     
-    wishlists = load_data(WISHLISTS_FILE)
-    
-    if user_id not in wishlists:
-        wishlists[user_id] = []
-    
-    wishlists[user_id].append(text)
-    save_data(wishlists, WISHLISTS_FILE)
+    storage.add_wishlist_item(user_id, text)
     
     keyboard = [
         [InlineKeyboardButton("Добавить еще", callback_data="add_more_items")],
@@ -182,22 +809,22 @@ async def wishlist_button_handler(update: Update, context: ContextTypes.DEFAULT_
     
     data = query.data
     user_id = str(query.from_user.id)
-    wishlists = load_data(WISHLISTS_FILE)
     
     if data == "add_more_items":
         context.user_data["wishlist_state"] = "awaiting_item"
         await query.edit_message_text("Введите следующую позицию:")
     
     elif data == "finish_wishlist":
-        items = "\n".join([f"{i+1}. {item}" for i, item in enumerate(wishlists[user_id])])
+        items = "\n".join([f"{i+1}. {item}" for i, item in enumerate(storage.get_wishlist(user_id))])
         await query.edit_message_text(f"Ваш wish-лист создан:\n{items}")
         if "wishlist_state" in context.user_data:
             del context.user_data["wishlist_state"]
     
     elif data == "update_wishlist":
-        if user_id in wishlists and wishlists[user_id]:
+        wishlist = storage.get_wishlist(user_id)
+        if wishlist:
             keyboard = []
-            for i, item in enumerate(wishlists[user_id]):
+            for i, item in enumerate(wishlist):
                 keyboard.append([InlineKeyboardButton(f"{i+1}. {item[:10]}...", callback_data=f"edit_{i}")])
             keyboard.append([InlineKeyboardButton("Отмена", callback_data="cancel")])
             await query.edit_message_text(
@@ -219,26 +846,22 @@ async def wishlist_button_handler(update: Update, context: ContextTypes.DEFAULT_
 async def handle_wishlist_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     text = censor_text(update.message.text.strip())
-    wishlists = load_data(WISHLISTS_FILE)
     
     if "edit_index" in context.user_data:
-        index = context.user_data["edit_index"]
-        wishlists[user_id][index] = text
-        save_data(wishlists, WISHLISTS_FILE)
-        del context.user_data["edit_index"]
-        if "wishlist_state" in context.user_data:
-            del context.user_data["wishlist_state"]
+        index = context.user_data.pop("edit_index")
+        context.user_data.pop("wishlist_state", None)
+        wishlist = storage.update_wishlist_item(user_id, index, text)
+        if wishlist is None:
+            await update.message.reply_text("Такой позиции уже нет в wish-листе.")
+            return
         
-        items = "\n".join([f"{i+1}. {item}" for i, item in enumerate(wishlists[user_id])])
+        items = "\n".join([f"{i+1}. {item}" for i, item in enumerate(wishlist)])
         await update.message.reply_text(f"Позиция обновлена! Ваш wish-лист:\n{items}")
 
 async def delete_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    wishlists = load_data(WISHLISTS_FILE)
     
-    if user_id in wishlists:
-        del wishlists[user_id]
-        save_data(wishlists, WISHLISTS_FILE)
+    if storage.delete_wishlist(user_id):
         await update.message.reply_text("Ваш wish-лист удален!")
     else:
         await update.message.reply_text("У вас нет wish-листа.")
@@ -259,37 +882,167 @@ async def handle_birthday_input(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Неверный формат даты. Используйте ДД.ММ (например, 15.05)")
         return
     
-    birthdays = load_data(BIRTHDAYS_FILE)
-    birthdays[user_id] = text
-    save_data(birthdays, BIRTHDAYS_FILE)
+    storage.set_birthday(user_id, text)
+    if scheduler is not None:
+        scheduler.replan(user_id)
     
     if "awaiting_birthday" in context.user_data:
         del context.user_data["awaiting_birthday"]
     await update.message.reply_text("Дата рождения сохранена! Теперь создайте wish-лист с помощью /my_wishlist")
 
+# ====================== Текстовые сообщения ======================
+
+# Обработчик текстового сообщения в ЛС по состоянию диалога в user_data: редактирование позиции,
+# добавление в wish-лист, ввод даты рождения. Дата без запроса тоже сохраняется, как раньше,
+# когда каждое сообщение проверялось на дату. None — сообщение ни к чему не относится
+def route_text(user_data: Dict, text: str):
+    if "edit_index" in user_data:
+        return handle_wishlist_update
+    if user_data.get("wishlist_state") in ("awaiting_first_item", "awaiting_item"):
+        return add_wishlist_item
+    if user_data.get("awaiting_birthday") or is_valid_date(text):
+        return handle_birthday_input
+    return None
+
+# Единственный обработчик текста в ЛС: каждое сообщение попадает ровно в один обработчик
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = route_text(context.user_data, update.message.text.strip())
+    if handler is None:
+        await update.message.reply_text(
+            "Чтобы указать дату рождения, отправьте её в формате ДД.ММ (например, 15.05).\n"
+            "Wish-лист: /my_wishlist"
+        )
+        return
+    await handler(update, context)
+
+# Имена пользователей в памяти процесса: uid -> (имя или None, когда получено). None — get_chat
+# не нашёл пользователя, такие записи живут PROFILE_MISS_TTL. Часы подменяются в проверках
+class ProfileCache:
+    def __init__(self, ttl: float = None, miss_ttl: float = None, concurrency: int = None, clock=time.monotonic):
+        self.ttl = PROFILE_TTL if ttl is None else ttl
+        self.miss_ttl = PROFILE_MISS_TTL if miss_ttl is None else miss_ttl
+        self.concurrency = concurrency or PROFILE_LOOKUP_CONCURRENCY
+        self.clock = clock
+        self.profiles: Dict[str, Tuple[Optional[str], float]] = {}
+        self._refreshing: set = set()  # uid, которые сейчас обновляются в фоне
+        self._tasks: set = set()
+        # Общий лимит get_chat для всех команд и фоновых обновлений
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Запросы в процессе: параллельные команды ждут один и тот же запрос к uid
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def remember(self, user):
+        if user is not None and not user.is_bot:
+            self.profiles[str(user.id)] = (_display_name(user), self.clock())
+
+    def _fresh(self, uid: str) -> bool:
+        name, updated = self.profiles[uid]
+        return self.clock() - updated < (self.ttl if name is not None else self.miss_ttl)
+
+    async def _fetch(self, bot, uid: str):
+        async with self._semaphore:
+            try:
+                with _stage("get_chat"):
+                    chat = await bot.get_chat(uid)
+            except BadRequest as e:
+                # Пользователь не найден (не писал боту, удалил аккаунт) — не спрашивать до miss_ttl
+                logger.error(f"Ошибка при получении информации о пользователе {uid}: {e}")
+                self.profiles[uid] = (None, self.clock())
+                return
+            except Exception as e:
+                # Сетевая ошибка или лимит: прежнее имя остаётся, следующий запрос попробует снова
+                logger.error(f"Ошибка при получении информации о пользователе {uid}: {e}")
+                return
+        self.profiles[uid] = (_display_name(chat), self.clock())
+
+    # shield: отмена одного ожидающего не отменяет запрос, который ждут другие
+    def _lookup(self, bot, uid: str):
+        task = self._pending.get(uid)
+        if task is None:
+            task = self._pending[uid] = asyncio.create_task(self._fetch(bot, uid))
+            task.add_done_callback(lambda _: self._pending.pop(uid, None))
+        return asyncio.shield(task)
+
+    async def _lookup_all(self, bot, uids: List[str]):
+        await asyncio.gather(*(self._lookup(bot, uid) for uid in uids))
+
+    async def _refresh(self, bot, uids: List[str]):
+        try:
+            await self._lookup_all(bot, uids)
+        finally:
+            self._refreshing.difference_update(uids)
+
+    def _refresh_later(self, bot, uids: List[str]):
+        uids = [uid for uid in uids if uid not in self._refreshing]
+        if uids:
+            self._refreshing.update(uids)
+            task = asyncio.create_task(self._refresh(bot, uids))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    # Имена для uids; None — пользователь не найден. Отсутствующие в кэше запрашиваются сразу,
+    # устаревшие отдаются как есть и обновляются в фоне
+    async def names(self, bot, uids: List[str]) -> Dict[str, Optional[str]]:
+        missing = [uid for uid in uids if uid not in self.profiles]
+        stale = [uid for uid in uids if uid in self.profiles and not self._fresh(uid)]
+        _event("profile_hit", len(uids) - len(missing) - len(stale))
+        _event("profile_miss", len(missing))
+        if missing:
+            await self._lookup_all(bot, missing)
+        if stale:
+            _event("profile_refresh", len(stale))
+            self._refresh_later(bot, stale)
+        return {uid: self.profiles[uid][0] if uid in self.profiles else None for uid in uids}
+
+def _display_name(user) -> str:
+    return user.first_name or user.username or f"Пользователь {user.id}"
+
+profiles = ProfileCache()
+
+# Запоминает авторов всех обновлений и новых участников групп; ничего не отвечает
+async def remember_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    profiles.remember(update.effective_user)
+    message = update.effective_message
+    if message is not None:
+        for member in message.new_chat_members or ():
+            profiles.remember(member)
+
+# Разбивка строк на сообщения не длиннее limit; заголовок — только в первом
+def split_message(header: str, lines: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    messages = []
+    current = header
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current += line
+    if current:
+        messages.append(current)
+    return messages
+
 async def show_all_birthdays(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    birthdays = load_data(BIRTHDAYS_FILE)
-    wishlists = load_data(WISHLISTS_FILE)
+    birthdays = storage.birthdays()
     
     if not birthdays:
         await update.message.reply_text("Пока нет сохраненных дней рождения.")
         return
     
-    response = "🎂 Дни рождения участников:\n\n"
-    for uid, date in birthdays.items():
-        try:
-            user = await context.bot.get_chat(uid)
-            name = user.first_name or user.username or f"Пользователь {uid}"
-            response += f"• {name}: {date}"
-            
-            if uid in wishlists and wishlists[uid]:
-                response += " [есть wish-лист]"
-            response += "\n"
-        except Exception as e:
-            logger.error(f"Ошибка при получении информации о пользователе {uid}: {e}")
+    uids = [uid for uid, _ in birthdays]
+    owners = storage.wishlist_owners(uids)
+    names = await profiles.names(context.bot, uids)
+    lines = []
+    for uid, date in birthdays:
+        name = names[uid]
+        if name is None:
             continue
+        line = f"• {name}: {date}"
+        if uid in owners:
+            line += " [есть wish-лист]"
+        lines.append(line + "\n")
     
-    await update.message.reply_text(response)
+    for text in split_message("🎂 Дни рождения участников:\n\n", lines):
+        await update.message.reply_text(text)
 
 # ====================== Админские команды ======================
 
@@ -307,56 +1060,377 @@ async def add_birthday_admin(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Неверный формат даты. Используйте ДД.ММ")
         return
     
-    birthdays = load_data(BIRTHDAYS_FILE)
-    birthdays[user_id] = date
-    save_data(birthdays, BIRTHDAYS_FILE)
+    storage.set_birthday(user_id, date)
+    if scheduler is not None:
+        scheduler.replan(user_id)
     await update.message.reply_text(f"День рождения для {user_id} добавлен!")
 
 # ====================== Напоминания ======================
 
-async def birthday_reminder(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    today_str = now.strftime("%d.%m")
-    
-    # Рассчитать дату через 2 недели
-    in_two_weeks = (now + timedelta(days=14)).strftime("%d.%m")
-    
-    birthdays = load_data(BIRTHDAYS_FILE)
-    wishlists = load_data(WISHLISTS_FILE)
+# Ведро токенов: rate штук в секунду, не больше capacity подряд. pause() останавливает выдачу,
+# когда Telegram ответил RetryAfter. Часы и sleep подменяются в проверках
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = self.clock()
+            if now < self.paused_until:
+                await self.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await self.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+class Delivery:
+    def __init__(self, key: str, chat_id: str, text: str):
+        self.key = key
+        self.chat_id = chat_id
+        self.text = text
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+# Параллельная рассылка с общим лимитом и лимитом на чат. Сообщения в один чат идут по очереди
+# с интервалом от фактической отправки предыдущего. RetryAfter приостанавливает всю рассылку
+# на указанное Telegram время, сетевые ошибки повторяются с экспоненциальной задержкой,
+# остальные ошибки (бот заблокирован, чат не найден) не повторяются. Доставленное отмечается
+# в хранилище сразу после отправки
+class FanOut:
+    def __init__(self, bot, global_rate: float = None, chat_rate: float = None, concurrency: int = None,
+                 attempts: int = None, clock=time.monotonic, sleep=asyncio.sleep):
+        self.bot = bot
+        self.chat_rate = chat_rate or FANOUT_CHAT_RATE
+        self.attempts = attempts or SEND_ATTEMPTS
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate or FANOUT_GLOBAL_RATE, clock=clock, sleep=sleep)
+        self.chat_locks: Dict[str, asyncio.Lock] = {}
+        self.chat_next: Dict[str, float] = {}  # Когда можно писать в чат в следующий раз
+        self.semaphore = asyncio.Semaphore(concurrency or FANOUT_CONCURRENCY)
+        self.stats = {"sent": 0, "skipped": 0, "failed": 0, "retried": 0}
+
+    def _count(self, outcome: str):
+        self.stats[outcome] += 1
+        _event(f"reminder_{outcome}")
+
+    async def _send(self, delivery: Delivery):
+        if storage.is_delivered(delivery.key):
+            self._count("skipped")
+            return
+        chat_id = delivery.chat_id
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+
+        async with lock, self.semaphore:
+            for attempt in range(self.attempts):
+                wait = self.chat_next.get(chat_id, 0.0) - self.clock()
+                if wait > 0:
+                    await self.sleep(wait)
+                await self.global_bucket.acquire()
+                try:
+                    await self.bot.send_message(int(chat_id), delivery.text)
+                except RetryAfter as e:
+                    self.global_bucket.pause(_retry_after_seconds(e))
+                except BadRequest as e:
+                    self._count("failed")
+                    logger.error(f"Ошибка при отправке напоминания {delivery.key}: {e}")
+                    return
+                except NetworkError as e:
+                    # С небольшим разбросом, чтобы повторы не совпадали по времени
+                    await self.sleep(RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random() / 2))
+                except Exception as e:
+                    self._count("failed")
+                    logger.error(f"Ошибка при отправке напоминания {delivery.key}: {e}")
+                    return
+                else:
+                    self.chat_next[chat_id] = self.clock() + 1 / self.chat_rate
+                    storage.mark_delivered(delivery.key, chat_id)
+                    self._count("sent")
+                    return
+                self._count("retried")
+
+        self._count("failed")
+        logger.error(f"Напоминание {delivery.key} не отправлено после {self.attempts} попыток")
+
+    async def run(self, deliveries: List[Delivery]) -> Dict[str, int]:
+        await asyncio.gather(*(self._send(delivery) for delivery in deliveries))
+        return self.stats
+
+# Кто празднует в этот день: родившиеся 29.02 в невисокосный год получают напоминания 28.02
+def birthdays_on_date(day: date) -> List[str]:
+    uids = storage.birthdays_on(day.month, day.day)
+    if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+        uids = uids + storage.birthdays_on(2, 29)
+    return uids
+
+def _days_word(days: int) -> str:
+    if days % 10 == 1 and days % 100 != 11:
+        return "день"
+    if 2 <= days % 10 <= 4 and not 12 <= days % 100 <= 14:
+        return "дня"
+    return "дней"
+
+def _reminder_text(birthday: date, days_left: int) -> str:
+    if days_left <= 0:
+        greeting = "🎉 С Днем Рождения! 🎂" if days_left == 0 else f"🎉 С прошедшим Днем Рождения ({birthday:%d.%m})! 🎂"
+        return f"{greeting}\n\nНе забудьте обновить ваш wish-лист с помощью /update_wishlist"
+    return (
+        f"Через {days_left} {_days_word(days_left)} ({birthday:%d.%m}) у вас День Рождения!\n"
+        "Проверьте ваш wish-лист: /my_wishlist"
+    )
+
+def _zone(name: Optional[str]):
+    return ZoneInfo(name) if name else None
+
+# Очередь напоминаний по времени отправки (куча): каждое напоминание уходит в ЛС в REMINDER_TIME
+# или в настроенное пользователем время по его часовому поясу. Дни планируются заранее, до завтрашнего
+# по часам сервера; день, все напоминания которого отправлены, записывается в хранилище, и после
+# перезапуска планирование продолжается с него. Часы (секунды Unix) и sleep подменяются в проверках
+class ReminderScheduler:
+    def __init__(self, bot, clock=time.time, sleep=asyncio.sleep, fanout: Optional[FanOut] = None):
+        self.clock = clock
+        self.sleep = sleep
+        self.fanout = fanout or FanOut(bot)
+        # (время отправки, порядковый номер, день рассылки, ключ, chat_id, день рождения)
+        self.heap: List[Tuple[float, int, date, str, str, date]] = []
+        self.order = itertools.count()
+        self.pending: Dict[date, int] = {}  # Неотправленные напоминания по дням рассылки
+        self.first_day: Optional[date] = None
+        self.planned_until: Optional[date] = None
+        self.done_day: Optional[date] = None
+        self.wakeup = asyncio.Event()
+
+    def _server_today(self) -> date:
+        return datetime.fromtimestamp(self.clock()).date()
+
+    def chat_settings(self, chat_id: str):
+        time_text, zone = storage.get_reminder_settings(chat_id) or (REMINDER_TIME, REMINDER_TIMEZONE)
+        return datetime.strptime(time_text, "%H:%M").time(), _zone(zone)
+
+    def fire_time(self, chat_id: str, run_day: date) -> float:
+        at, zone = self.chat_settings(chat_id)
+        # Без часового пояса — местное время сервера
+        return datetime.combine(run_day, at, tzinfo=zone).timestamp()
+
+    def _plan_day(self, run_day: date, chat_id: Optional[str] = None):
+        for lead in REMINDER_LEAD_DAYS:
+            birthday = run_day + timedelta(days=lead)
+            # Ключ с датой рассылки: перезапуск не отправит напоминание повторно
+            kind = "today" if lead == 0 else f"in{lead}"
+            for uid in birthdays_on_date(birthday):
+                if chat_id is not None and uid != chat_id:
+                    continue
+                entry = (self.fire_time(uid, run_day), next(self.order), run_day, f"{run_day.isoformat()}:{kind}:{uid}", uid, birthday)
+                heapq.heappush(self.heap, entry)
+                self.pending[run_day] = self.pending.get(run_day, 0) + 1
+
+    # Планирование дней от последнего выполненного (не дальше REMINDER_CATCHUP_DAYS назад) до завтрашнего
+    def plan(self):
+        today = self._server_today()
+        if self.planned_until is None:
+            last_run = storage.get_meta("reminders_last_run")
+            first = date.fromisoformat(last_run) + timedelta(days=1) if last_run else today
+            self.first_day = max(first, today - timedelta(days=REMINDER_CATCHUP_DAYS - 1))
+            self.planned_until = self.first_day - timedelta(days=1)
+        while self.planned_until < today + timedelta(days=1):
+            self.planned_until += timedelta(days=1)
+            self._plan_day(self.planned_until)
+
+    # Перепланирование чата после смены даты рождения или настроек; прошедшие дни не трогаются
+    def replan(self, chat_id: str):
+        if self.planned_until is None:
+            return
+        first = max(self.first_day, self._server_today())
+        kept = []
+        for entry in self.heap:
+            if entry[4] == chat_id and entry[2] >= first:
+                self.pending[entry[2]] -= 1
+            else:
+                kept.append(entry)
+        heapq.heapify(kept)
+        self.heap = kept
+        run_day = first
+        while run_day <= self.planned_until:
+            self._plan_day(run_day, chat_id)
+            run_day += timedelta(days=1)
+        self.wakeup.set()
+
+    # День выполнен, когда по нему нечего отправлять; сегодняшний — только на следующий день,
+    # чтобы дата рождения, указанная сегодня, попала в рассылку и после перезапуска
+    def _save_progress(self):
+        pending = [run_day for run_day, count in self.pending.items() if count > 0]
+        done = min(min(pending, default=self.planned_until + timedelta(days=1)), self._server_today()) - timedelta(days=1)
+        if self.done_day is None or done > self.done_day:
+            self.done_day = done
+            storage.set_meta("reminders_last_run", done.isoformat())
+            storage.prune_deliveries(self.clock() - DELIVERY_RETENTION_DAYS * 86400)
+
+    # Отправка наступивших напоминаний; возвращает время следующего или None
+    async def run_due(self) -> Optional[float]:
+        self.plan()
+        now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        if due:
+            deliveries = []
+            for _, _, run_day, key, chat_id, birthday in due:
+                today = datetime.fromtimestamp(now, self.chat_settings(chat_id)[1]).date()
+                if run_day < today:
+                    _event("reminder_catchup")
+                deliveries.append(Delivery(key, chat_id, _reminder_text(birthday, (birthday - today).days)))
+            with _stage("birthday_reminder"):
+                await self.fanout.run(deliveries)
+            for entry in due:
+                self.pending[entry[2]] -= 1
+        self._save_progress()
+        return self.heap[0][0] if self.heap else None
+
+    async def run(self):
+        while True:
+            try:
+                next_at = await self.run_due()
+            except Exception as e:
+                logger.error(f"Ошибка планировщика напоминаний: {e}")
+                next_at = None
+            timeout = SCHEDULER_IDLE if next_at is None else min(max(next_at - self.clock(), 0), SCHEDULER_IDLE)
+            # Сон до ближайшего напоминания или до перепланирования
+            self.wakeup.clear()
+            sleeper = asyncio.ensure_future(self.sleep(timeout))
+            waiter = asyncio.ensure_future(self.wakeup.wait())
+            await asyncio.wait((sleeper, waiter), return_when=asyncio.FIRST_COMPLETED)
+            sleeper.cancel()
+            waiter.cancel()
+
+scheduler: Optional[ReminderScheduler] = None
+_scheduler_task: Optional[asyncio.Task] = None
+
+def start_reminders(application: Application):
+    global scheduler, _scheduler_task
+    scheduler = ReminderScheduler(application.bot)
+    _scheduler_task = asyncio.create_task(scheduler.run())
+
+async def stop_reminders():
+    global scheduler, _scheduler_task
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        try:
+            await _scheduler_task
+        except asyncio.CancelledError:
+            pass
+    scheduler = _scheduler_task = None
+
+async def set_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    chat_id = str(chat.id)
+    # Напоминания приходят только в ЛС, поэтому и время настраивается там, каждым для себя
+    if chat.type != "private":
+        await update.message.reply_text(
+            "Время напоминаний настраивается в личных сообщениях: напишите мне /set_reminder_time"
+        )
+        return
     
-    # Ищем именинников
-    today_birthday_users = [uid for uid, date in birthdays.items() if date == today_str]
-    future_birthday_users = [uid for uid, date in birthdays.items() if date == in_two_weeks]
+    time_text, zone = storage.get_reminder_settings(chat_id) or (REMINDER_TIME, REMINDER_TIMEZONE)
+    if not context.args:
+        await update.message.reply_text(
+            f"Напоминания приходят в {time_text} ({zone or 'время сервера'}).\n"
+            "Изменить: /set_reminder_time ЧЧ:ММ [часовой пояс, например Europe/Moscow]"
+        )
+        return
+    if len(context.args) > 2:
+        await update.message.reply_text("Использование: /set_reminder_time ЧЧ:ММ [часовой пояс]")
+        return
     
-    # Отправка напоминаний
-    for uid in today_birthday_users:
+    try:
+        time_text = datetime.strptime(context.args[0], "%H:%M").strftime("%H:%M")
+    except ValueError:
+        await update.message.reply_text("Неверный формат времени. Используйте ЧЧ:ММ (например, 09:30)")
+        return
+    if len(context.args) == 2:
+        zone = context.args[1]
         try:
-            await context.bot.send_message(
-                int(uid),
-                "🎉 С Днем Рождения! 🎂\n\n"
-                "Не забудьте обновить ваш wish-лист с помощью /update_wishlist"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке напоминания: {e}")
+            _zone(zone)
+        except (ZoneInfoNotFoundError, ValueError):
+            await update.message.reply_text("Неизвестный часовой пояс. Пример: Europe/Moscow, Asia/Yekaterinburg")
+            return
     
-    for uid in future_birthday_users:
-        try:
-            await context.bot.send_message(
-                int(uid),
-                f"Через 2 недели ({in_two_weeks}) у вас День Рождения!\n"
-                "Проверьте ваш wish-лист: /my_wishlist"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке напоминания: {e}")
+    storage.set_reminder_settings(chat_id, time_text, zone)
+    if scheduler is not None:
+        scheduler.replan(chat_id)
+    await update.message.reply_text(f"Напоминания будут приходить в {time_text} ({zone or 'время сервера'}).")
 
 # ====================== Основная функция ======================
 
-def main():
-    # Загрузка токена из файла
-    with open("token.txt", "r") as f:
-        token = f.read().strip()
+# Параллельная обработка обновлений с очередью на каждого пользователя (или чат, если обновление
+# не от пользователя): сообщения одного человека меняют его состояние диалога в user_data строго
+# по порядку, а разные пользователи не ждут друг друга
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        # Семафор базового класса берётся до очереди пользователя, и ждущие своей очереди занимали бы
+        # места обработки. Поэтому он ограничивает только число обновлений в работе вместе с очередями
+        # (max_concurrent_updates приложения), а одновременную обработку — свой семафор после очереди
+        super().__init__(max_concurrent_updates * 64)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self.queued: Dict[Tuple[str, int], int] = {}  # Обновлений в очереди ключа, включая текущее
+
+    @staticmethod
+    def _key(update: object) -> Optional[Tuple[str, int]]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return "user", update.effective_user.id
+        if update.effective_chat is not None:
+            return "chat", update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.queued[key] = self.queued.get(key, 0) + 1
+        try:
+            async with lock, self.running:
+                await coroutine
+        finally:
+            # Замки пользователей без обновлений в очереди не хранятся
+            self.queued[key] -= 1
+            if not self.queued[key]:
+                del self.queued[key]
+                del self.locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Приложение с обработчиками; используется и с run_polling, и в режиме webhook
+def build_application(token: str, concurrent_updates: Optional[int] = None) -> Application:
+    builder = Application.builder().token(token).post_init(on_startup).post_shutdown(on_shutdown)
+    if concurrent_updates and concurrent_updates > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(concurrent_updates))
+    application = builder.build()
     
-    application = Application.builder().token(token).build()
+    # Имена авторов обновлений для /birthdays; отдельная группа, чтобы не мешать остальным обработчикам
+    application.add_handler(TypeHandler(Update, remember_profiles), group=-2)
     
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
@@ -364,18 +1438,13 @@ def main():
     application.add_handler(CommandHandler("delete_wishlist", delete_wishlist))
     application.add_handler(CommandHandler("birthdays", show_all_birthdays))
     application.add_handler(CommandHandler("add_birthday", add_birthday_admin))
+    application.add_handler(CommandHandler("set_reminder_time", set_reminder_time))
     
-    # Обработчики сообщений
+    # Текстовые сообщения в ЛС: дата рождения и wish-лист по состоянию диалога
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-        handle_birthday_input),
-        group=1
-    )
-    application.add_handler(MessageHandler(
-        filters.TEXT & filters.ChatType.PRIVATE,
-        add_wishlist_item),
-        group=2
-    )
+        handle_text
+    ))
     
     # Обработчики callback-кнопок
     application.add_handler(CallbackQueryHandler(create_wishlist_start, pattern="^create_wishlist$"))
@@ -383,14 +1452,28 @@ def main():
     
     # Обработчик новых участников
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
+    return application
+
+def main():
+    # Загрузка токена из файла
+    with open("token.txt", "r") as f:
+        token = f.read().strip()
+
+    if METRICS_PORT:
+        bot_metrics.start_http_server(METRICS_PORT)
+
+    if WEBHOOK_PORT:
+        application = build_application(token, concurrent_updates=WEBHOOK_CONCURRENT_UPDATES)
+        server = bot_webhook.WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL, WEBHOOK_CONCURRENT_UPDATES)
+        server.add("arh_m", application, secret=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+        bot_webhook.run(server)
+        return
+
+    application = build_application(token, concurrent_updates=CONCURRENT_UPDATES)
+    bot_webhook.add_latency_probe(application, "arh_m", "polling")
     
-    # Запланированные задачи (напоминания)
-    job_queue = application.job_queue
-    job_queue.run_daily(birthday_reminder, time=datetime.strptime("13:00", "%H:%M").time())
-    
-   
     # Запуск бота
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,538 @@
+import os
+import sys
+import time
+import random
+import re
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+from telegram.error import NetworkError, RetryAfter, Forbidden
+
+import bot_webhook
+
+# Модуль arh.m_bot.py загружается по пути: имя файла с точкой не импортируется обычным import
+arh = bot_webhook.load_bot_module("arh_m")
+
+# ====================== Рассылка напоминаний ======================
+
+# Ускоренное время: секунда Telegram проходит за 1/scale настоящей
+class ScaledClock:
+    def __init__(self, scale):
+        self.scale = scale
+        self.origin = time.monotonic()
+
+    def __call__(self):
+        return (time.monotonic() - self.origin) * self.scale
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds / self.scale)
+
+# Заглушка бота с лимитами Telegram: больше global_rate сообщений за секунду или больше
+# chat_rate в один чат — RetryAfter; часть отправок падает сетевой ошибкой
+class RateLimitedBot:
+    def __init__(self, clock, global_rate=30, chat_rate=1, error_rate=0.0, blocked=(), seed=1):
+        self.clock = clock
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.error_rate = error_rate
+        self.blocked = set(blocked)
+        self.rng = random.Random(seed)
+        self.window = []  # Время отправок за последнюю секунду
+        self.chat_last = {}
+        self.received = []  # (chat_id, text)
+        self.retry_after = 0
+        self.network_errors = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        now = self.clock()
+        self.window = [t for t in self.window if now - t < 1.0]
+        # Небольшой допуск на неточность таймеров, как и у настоящего Telegram
+        if len(self.window) >= self.global_rate or now - self.chat_last.get(chat_id, -1e9) < 0.9 / self.chat_rate:
+            self.retry_after += 1
+            raise RetryAfter(1)
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        if self.rng.random() < self.error_rate:
+            self.network_errors += 1
+            raise NetworkError("Connection reset")
+        self.window.append(now)
+        self.chat_last[chat_id] = now
+        self.received.append((chat_id, text))
+
+async def run_fanout(deliveries, bot, clock):
+    fanout = arh.FanOut(bot, clock=clock, sleep=clock.sleep)
+    started = clock()
+    stats = await fanout.run(deliveries)
+    return stats, clock() - started
+
+def bench_fanout(args):
+    clock = ScaledClock(args.rate_scale)
+    with tempfile.TemporaryDirectory(prefix="arh_m_bench_") as work_dir:
+        arh.storage = arh.SqliteStorage(os.path.join(work_dir, "bench.sqlite3"))
+        arh.storage.load()
+
+        chats = [str(100000 + i) for i in range(args.chats)]
+        deliveries = [
+            arh.Delivery(f"bench:{kind}:{chat}", chat, f"{kind} {chat}")
+            for chat in chats for kind in range(args.per_chat)
+        ]
+        blocked = {int(chat) for chat in chats[:args.blocked]}
+        bot = RateLimitedBot(clock, error_rate=args.error_rate, blocked=blocked)
+
+        stats, seconds = asyncio.run(run_fanout(deliveries, bot, clock))
+        duplicates = len(bot.received) - len(set(bot.received))
+        print(
+            f"fanout deliveries={len(deliveries)} chats={args.chats} "
+            f"time={seconds:.1f}s по часам Telegram ({seconds / args.rate_scale:.2f}s реально) stats={stats} "
+            f"retry_after={bot.retry_after} network_errors={bot.network_errors} duplicates={duplicates}"
+        )
+
+        # Повторный запуск (например, после перезапуска бота) ничего не отправляет повторно
+        received = len(bot.received)
+        stats, _ = asyncio.run(run_fanout(deliveries, bot, clock))
+        print(f"rerun stats={stats} resent={len(bot.received) - received}")
+        asyncio.run(arh.storage.close())
+
+        expected = len(deliveries) - args.blocked * args.per_chat
+        if duplicates or len(bot.received) != expected:
+            print(f"Ожидалось {expected} доставок без повторов, получено {len(bot.received)}", file=sys.stderr)
+            return 1
+    return 0
+
+# ====================== Планировщик напоминаний ======================
+
+ZONES = ("Europe/Kaliningrad", "Europe/Moscow", "Asia/Yekaterinburg", "Asia/Novosibirsk",
+         "Asia/Vladivostok", "Europe/Berlin", "America/New_York", None)
+
+# Бот, который только записывает время отправки по часам планировщика
+class RecordingBot:
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []  # (время отправки, chat_id, текст)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((self.clock(), chat_id, text))
+
+# Модельное время: sleep не ждёт, а переводит часы, не меньше чем на разрешение таймеров asyncio.
+# Прошедшее время хранится отдельно от начала в секундах Unix, чтобы не терять точность
+class ManualClock:
+    def __init__(self, origin):
+        self.origin = origin
+        self.elapsed = 0.0
+
+    def __call__(self):
+        return self.origin + self.elapsed
+
+    async def sleep(self, seconds):
+        self.elapsed += max(seconds, 0.001)
+
+async def run_schedule(bot, clock, days):
+    # Рассылка с настоящими лимитами, но на модельных часах, отсчитанных от начала модели
+    fanout = arh.FanOut(bot, clock=lambda: clock.elapsed, sleep=clock.sleep)
+    scheduler = arh.ReminderScheduler(bot, clock=clock, sleep=clock.sleep, fanout=fanout)
+    while clock.elapsed < days * 86400:
+        next_at = await scheduler.run_due()
+        wait = arh.SCHEDULER_IDLE if next_at is None else min(next_at - clock(), arh.SCHEDULER_IDLE)
+        clock.elapsed += max(wait, 0.0)
+    return scheduler
+
+def bench_schedule(args):
+    rng = random.Random(1)
+    start = datetime(2027, 3, 1, tzinfo=timezone.utc)
+    with tempfile.TemporaryDirectory(prefix="arh_m_bench_") as work_dir:
+        arh.storage = arh.SqliteStorage(os.path.join(work_dir, "bench.sqlite3"))
+        arh.storage.load()
+        for i in range(args.users):
+            uid = str(100000 + i)
+            birthday = start + timedelta(days=rng.randrange(args.days))
+            arh.storage.set_birthday(uid, birthday.strftime("%d.%m"))
+            if rng.random() < args.configured:
+                at = f"{rng.randrange(8, 22):02d}:{rng.choice((0, 15, 30, 45)):02d}"
+                arh.storage.set_reminder_settings(uid, at, rng.choice(ZONES))
+
+        clock = ManualClock(start.timestamp())
+        bot = RecordingBot(clock)
+        started = time.perf_counter()
+        scheduler = asyncio.run(run_schedule(bot, clock, args.days))
+        seconds = time.perf_counter() - started
+
+        per_minute = {}
+        for sent_at, _, _ in bot.sent:
+            minute = int(sent_at // 60)
+            per_minute[minute] = per_minute.get(minute, 0) + 1
+        # Каждое напоминание за смоделированные дни отправлено или ещё ждёт своего времени, без повторов
+        duplicates = len(bot.sent) - len({(chat_id, text) for _, chat_id, text in bot.sent})
+        # Планирование начинается с текущего дня по часам сервера
+        first_day = datetime.fromtimestamp(start.timestamp()).date()
+        expected = sum(
+            1 for _, date in arh.storage.birthdays() for lead in arh.REMINDER_LEAD_DAYS
+            if lead <= (datetime.strptime(f"{date}.2027", "%d.%m.%Y").date() - first_day).days
+        )
+        print(
+            f"schedule users={args.users} days={args.days} sent={len(bot.sent)} pending={len(scheduler.heap)} "
+            f"expected={expected} duplicates={duplicates} "
+            f"minutes_with_sends={len(per_minute)} max_per_minute={max(per_minute.values(), default=0)} "
+            f"time={seconds:.2f}s"
+        )
+        asyncio.run(arh.storage.close())
+        return 0 if len(bot.sent) + len(scheduler.heap) == expected and not duplicates else 1
+
+# ====================== Цензура ======================
+
+LETTERS = "абвгдежзийклмнопрстуфхцчшщыэюя"
+
+def random_word(rng):
+    return "".join(rng.choice(LETTERS) for _ in range(rng.randrange(4, 11)))
+
+# Прежняя реализация: re.sub на каждое слово списка
+def naive_censor(text, words):
+    for word in words:
+        text = re.sub(re.escape(word), "***", text, flags=re.IGNORECASE)
+    return text
+
+def bench_censor(args):
+    rng = random.Random(1)
+    words = [random_word(rng) for _ in range(max(args.sizes))]
+    messages = [
+        " ".join(random_word(rng) for _ in range(rng.randrange(3, 12)))
+        for _ in range(args.messages)
+    ]
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="arh_m_bench_") as work_dir:
+        path = os.path.join(work_dir, "censor_words.txt")
+        for size in args.sizes:
+            # Часть сообщений содержит слово из списка, в том числе с латинскими буквами вместо похожих
+            sample = words[:size]
+            texts = [
+                text + " " + rng.choice(sample).upper().replace("А", "A").replace("О", "O") if i % 4 == 0 else text
+                for i, text in enumerate(messages)
+            ]
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(sample))
+
+            censor = arh.Censor(path, check_interval=0)
+            started = time.perf_counter()
+            censor.reload()
+            compile_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            censored = [censor.censor(text) for text in texts]
+            per_message = (time.perf_counter() - started) / len(texts) * 1e6
+            hidden = sum("***" in text for text in censored[::4])
+            failed += hidden != len(censored[::4])
+
+            line = (
+                f"censor words={size} compile={compile_ms:.1f}ms per_message={per_message:.1f}us "
+                f"hidden={hidden}/{len(censored[::4])}"
+            )
+            if size <= args.naive_limit:
+                naive_texts = texts[:200]
+                started = time.perf_counter()
+                for text in naive_texts:
+                    naive_censor(text, sample)
+                line += f" naive_per_message={(time.perf_counter() - started) / len(naive_texts) * 1e6:.1f}us"
+            print(line)
+
+        # Изменение файла подхватывается без перезапуска
+        censor = arh.Censor(path, check_interval=0)
+        before = censor.censor("новоеслово")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\nновоеслово")
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1))
+        after = censor.censor("новоеслово")
+        print(f"hot reload: before={before!r} after={after!r}")
+        failed += after != "***"
+    return 1 if failed else 0
+
+# ====================== Маршрутизация сообщений ======================
+
+# Хранилище, которое считает обращения обработчиков
+class CountingStorage:
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+        return counted
+
+# Бот, который записывает ответы вместо отправки в Telegram; с delay каждый запрос к API
+# занимает случайное время, как по сети
+class ReplyBot:
+    def __init__(self, delay=0.0, seed=1):
+        self.replies = []
+        self.id = 1
+        self.username = "arh_m_bench_bot"
+        self.delay = delay
+        self.rng = random.Random(seed)
+
+    async def _request(self):
+        if self.delay:
+            await asyncio.sleep(self.rng.random() * self.delay)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._request()
+        self.replies.append(text)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        await self._request()
+
+    async def edit_message_text(self, text, **kwargs):
+        await self._request()
+        self.replies.append(text)
+
+class FakeContext:
+    def __init__(self, bot, user_data):
+        self.bot = bot
+        self.user_data = user_data
+        self.args = None
+
+    def update(self, data):
+        for key, value in data.items():
+            setattr(self, key, value)
+
+# Заменяет Application.process_update: в каждой группе обработчиков срабатывает первый подходящий
+async def dispatch(application, update, context):
+    handled = []
+    for group in sorted(application.handlers):
+        for handler in application.handlers[group]:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                handled.append(handler.callback.__name__)
+                await handler.handle_update(update, application, check, context)
+                break
+    return handled
+
+def message_update(text, chat_type="private", user_id=555, bot=None):
+    chat_id = user_id if chat_type == "private" else -100
+    data = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        },
+    }
+    if text.startswith("/"):
+        data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json(data, bot)
+
+def callback_update(data, user_id, bot=None):
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {
+            "id": str(user_id), "from": user, "chat_instance": str(user_id), "data": data,
+            "message": {
+                "message_id": 1, "date": int(time.time()), "text": "меню",
+                "chat": {"id": user_id, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            },
+        },
+    }, bot)
+
+# Обработчики, в которые handle_text передаёт сообщение через route_text
+TEXT_HANDLERS = ("handle_birthday_input", "add_wishlist_item", "handle_wishlist_update")
+
+# Подменяет обработчики текста в модуле бота обёртками, которые записывают, какой из них вызван.
+# route_text берёт их из глобальных имён модуля при каждом вызове
+def record_text_handlers(called):
+    def recording(func):
+        async def wrapper(update, context):
+            called.append(func.__name__)
+            await func(update, context)
+        return wrapper
+
+    for name in TEXT_HANDLERS:
+        setattr(arh, name, recording(getattr(arh, name)))
+
+# (описание, user_data до, текст, тип чата, обработчик текста, обращения к хранилищу, user_data после)
+ROUTES = [
+    ("дата без запроса", {}, "15.05", "private", "handle_birthday_input", ["set_birthday"], {}),
+    ("посторонний текст", {}, "привет", "private", None, [], {}),
+    ("неверная дата по запросу", {"awaiting_birthday": True}, "32.13", "private", "handle_birthday_input", [],
+     {"awaiting_birthday": True}),
+    ("дата по запросу", {"awaiting_birthday": True}, "01.02", "private", "handle_birthday_input", ["set_birthday"], {}),
+    ("первая позиция похожа на дату", {"wishlist_state": "awaiting_first_item"}, "15.05", "private",
+     "add_wishlist_item", ["add_wishlist_item"], {"wishlist_state": "awaiting_first_item"}),
+    ("следующая позиция", {"wishlist_state": "awaiting_item"}, "книга", "private", "add_wishlist_item",
+     ["add_wishlist_item"], {"wishlist_state": "awaiting_item"}),
+    ("редактирование", {"wishlist_state": "awaiting_edit", "edit_index": 0}, "новая книга", "private",
+     "handle_wishlist_update", ["update_wishlist_item"], {}),
+    ("редактирование удалённой позиции", {"wishlist_state": "awaiting_edit", "edit_index": 9}, "x", "private",
+     "handle_wishlist_update", ["update_wishlist_item"], {}),
+    ("команда не попадает в wish-лист", {"wishlist_state": "awaiting_item"}, "/my_wishlist", "private",
+     "show_wishlist_menu", ["get_wishlist"], {"wishlist_state": "awaiting_item"}),
+    ("текст в группе", {"awaiting_birthday": True}, "01.02", "group", None, [], {"awaiting_birthday": True}),
+]
+
+def bench_routes(args):
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="arh_m_bench_") as work_dir:
+        real = arh.JsonStorage(*(os.path.join(work_dir, name) for name in (
+            "birthdays.json", "wishlists.json", "deliveries.json", "meta.json", "settings.json")))
+        real.add_wishlist_item("555", "книга")
+        counting = arh.storage = CountingStorage(real)
+        application = arh.build_application("1:bench")
+        called = []
+        record_text_handlers(called)
+
+        for name, before, text, chat_type, expected_handler, expected_calls, expected_after in ROUTES:
+            bot = ReplyBot()
+            update = message_update(text, chat_type)
+            update.message.set_bot(bot)
+            context = FakeContext(bot, dict(before))
+            counting.calls.clear()
+            called.clear()
+            handled = asyncio.run(dispatch(application, update, context))
+
+            # Кроме запоминания профиля, сообщение обрабатывает не больше одного обработчика
+            handlers = [name for name in handled if name != "remember_profiles"]
+            handler = handlers[0] if handlers else None
+            if handler == "handle_text":
+                handler = called[0] if called else None
+            ok = (
+                len(handlers) <= 1 and len(called) <= 1 and handler == expected_handler
+                and counting.calls == expected_calls and context.user_data == expected_after
+            )
+            failed += not ok
+            print(
+                f"{'ok  ' if ok else 'FAIL'} {name}: обработчик={handler} хранилище={counting.calls} "
+                f"user_data={context.user_data} ответ={bot.replies[-1][:40] if bot.replies else None!r}"
+            )
+    return 1 if failed else 0
+
+# ====================== Параллельные обновления ======================
+
+def open_storage(backend, work_dir):
+    if backend == "sqlite":
+        return arh.SqliteStorage(
+            os.path.join(work_dir, "bench.sqlite3"),
+            os.path.join(work_dir, "birthdays.json"), os.path.join(work_dir, "wishlists.json")
+        )
+    return arh.JsonStorage(*(os.path.join(work_dir, name) for name in (
+        "birthdays.json", "wishlists.json", "deliveries.json", "meta.json", "settings.json")))
+
+# Каждый пользователь присылает дату рождения, нажимает "Создать wish-лист" и добавляет позиции;
+# обновления обрабатываются параллельно, как с concurrent_updates
+async def run_stress(application, processor, users, items, delay):
+    bot = ReplyBot(delay=delay)
+    contexts = {uid: FakeContext(bot, {}) for uid in users}
+    per_user = {
+        uid: [message_update(f"{uid % 28 + 1:02d}.{uid % 12 + 1:02d}", user_id=uid, bot=bot),
+              callback_update("create_wishlist", uid, bot=bot)]
+             + [message_update(f"подарок {uid}-{i}", user_id=uid, bot=bot) for i in range(items)]
+        for uid in users
+    }
+    # Обновления пользователя идут подряд, как при быстром наборе, пользователи — вперемешку
+    updates = [(uid, update) for uid in users for update in per_user[uid]]
+    await processor.initialize()
+    await asyncio.gather(*(
+        processor.process_update(update, dispatch(application, update, contexts[uid])) for uid, update in updates
+    ))
+    await processor.shutdown()
+    return len(updates)
+
+def check_stress(storage, users, items):
+    lost = 0
+    for uid in users:
+        key = str(uid)
+        if storage.get_birthday(key) != f"{uid % 28 + 1:02d}.{uid % 12 + 1:02d}":
+            lost += 1
+        expected = [f"подарок {uid}-{i}" for i in range(items)]
+        wishlist = storage.get_wishlist(key)
+        lost += sum(item not in wishlist for item in expected)
+        if [item for item in wishlist if item in expected] != expected:
+            lost += 1  # Позиции не в том порядке
+        lost += len(wishlist) - len(set(wishlist) & set(expected))  # Лишнее (дата в wish-листе)
+    return lost
+
+def bench_stress(args):
+    users = list(range(100000, 100000 + args.users))
+    with tempfile.TemporaryDirectory(prefix="arh_m_bench_") as work_dir:
+        arh.storage = open_storage(args.backend, work_dir)
+        arh.storage.load()
+        application = arh.build_application("1:bench")
+        if args.processor == "per-user":
+            processor = arh.PerUserUpdateProcessor(args.concurrency)
+        else:
+            processor = SimpleUpdateProcessor(args.concurrency)
+
+        async def run():
+            count = await run_stress(application, processor, users, args.items, args.delay)
+            # Отложенная запись JSON выполняется при остановке бота
+            await arh.storage.close()
+            return count
+
+        started = time.perf_counter()
+        count = asyncio.run(run())
+        seconds = time.perf_counter() - started
+
+        # Проверка по данным, перечитанным с диска
+        arh.storage = open_storage(args.backend, work_dir)
+        arh.storage.load()
+        lost = check_stress(arh.storage, users, args.items)
+        asyncio.run(arh.storage.close())
+        print(
+            f"stress backend={args.backend} processor={args.processor} updates={count} "
+            f"concurrency={args.concurrency} time={seconds:.2f}s ({count / seconds:.0f} updates/s) lost_or_misplaced={lost}"
+        )
+    return 1 if lost else 0
+
+# ====================== Запуск ======================
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки arh.m_bot на заглушках Telegram")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fanout = commands.add_parser("fanout", help="рассылка напоминаний против заглушки с лимитами Telegram")
+    fanout.add_argument("--chats", type=int, default=300)
+    fanout.add_argument("--per-chat", type=int, default=2, help="напоминаний в каждый чат")
+    fanout.add_argument("--blocked", type=int, default=5, help="чатов, заблокировавших бота")
+    fanout.add_argument("--error-rate", type=float, default=0.05, help="доля отправок с сетевой ошибкой")
+    fanout.add_argument("--rate-scale", type=float, default=20, help="ускорение времени относительно Telegram")
+
+    schedule = commands.add_parser("schedule", help="напоминания по часовым поясам на подменённых часах")
+    schedule.add_argument("--users", type=int, default=2000)
+    schedule.add_argument("--days", type=int, default=30, help="сколько дней моделировать")
+    schedule.add_argument("--configured", type=float, default=0.5, help="доля пользователей со своим временем")
+
+    censor = commands.add_parser("censor", help="цензура сообщений при росте списка слов")
+    censor.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    censor.add_argument("--messages", type=int, default=5000)
+    censor.add_argument("--naive-limit", type=int, default=1000, help="до какого размера списка мерить прежнюю реализацию")
+
+    commands.add_parser("routes", help="маршрутизация текстовых сообщений по состоянию диалога")
+
+    stress = commands.add_parser("stress", help="тысячи параллельных обновлений дат рождения и wish-листов")
+    stress.add_argument("--users", type=int, default=500)
+    stress.add_argument("--items", type=int, default=5, help="позиций wish-листа на пользователя")
+    stress.add_argument("--backend", choices=("sqlite", "json"), default="sqlite")
+    stress.add_argument("--concurrency", type=int, default=arh.WEBHOOK_CONCURRENT_UPDATES)
+    stress.add_argument(
+        "--processor", choices=("per-user", "simple"), default="per-user",
+        help="simple — без очереди на пользователя, для сравнения"
+    )
+    stress.add_argument("--delay", type=float, default=0.005, help="максимальная задержка ответа API, секунды")
+    args = parser.parse_args()
+
+    if args.command == "fanout":
+        return bench_fanout(args)
+    if args.command == "schedule":
+        return bench_schedule(args)
+    if args.command == "censor":
+        return bench_censor(args)
+    if args.command == "routes":
+        return bench_routes(args)
+    if args.command == "stress":
+        return bench_stress(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
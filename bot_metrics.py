@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Общие метрики для phonestat_bot и arh.m_bot: гистограммы длительности этапов и счётчики
+# событий в памяти процесса, выдача в текстовом формате Prometheus на локальном порту
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (секунды)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Этапы дольше порога пишутся в лог с предупреждением; None — не писать
+SLOW_THRESHOLD = 5.0
+
+STAGE_SECONDS = "stage_duration_seconds"
+EVENTS = "events_total"
+
+_lock = threading.Lock()
+_histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+_counters = {}  # (имя, метки) -> значение
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, seconds, slow=None, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    threshold = SLOW_THRESHOLD if slow is None else slow
+    if threshold is not None and seconds >= threshold:
+        logger.warning(f"Медленный этап {name} {labels}: {seconds:.3f} с")
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+# Замер блока кода: with timed(STAGE_SECONDS, bot="phonestat", stage="download"): ...
+@contextmanager
+def timed(name, slow=None, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, slow=slow, **labels)
+
+def _format_labels(labels, extra=()):
+    pairs = [f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render():
+    lines = []
+    with _lock:
+        histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+        counters = sorted(_counters.items())
+
+    declared = set()
+    for (name, labels), (buckets, total, count) in histograms:
+        if name not in declared:
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        cumulative = 0
+        for bound, hits in zip(BUCKETS, buckets):
+            cumulative += hits
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for (name, labels), value in counters:
+        if name not in declared:
+            lines.append(f"# TYPE {name} counter")
+            declared.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# HTTP-сервер /metrics в фоновом потоке; по умолчанию слушает только localhost
+def start_http_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,394 @@
+import os
+import sys
+import hmac
+import json
+import time
+import asyncio
+import logging
+import secrets
+import argparse
+import importlib.util
+import urllib.error
+import urllib.request
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot_metrics
+
+# Режим webhook для phonestat_bot и arh.m_bot: локальный HTTP-сервер принимает обновления от Telegram
+# и кладёт их в очередь приложения. Несколько ботов обслуживаются одним процессом на разных путях
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY = 1024 * 1024  # Обновления Telegram намного меньше; всё крупнее отклоняется
+UPDATE_LATENCY = "update_latency_seconds"
+WEBHOOK_REQUESTS = "webhook_requests_total"
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large",
+}
+
+# Модули ботов для запуска нескольких ботов в одном процессе (имя -> файл рядом с этим модулем)
+BOT_MODULES = {
+    "phonestat": "phonestat_bot.py",
+    "arh_m": "arh.m_bot.py",
+}
+
+# Задержка от отправки сообщения (message.date) до начала обработки, с меткой режима получения
+# обновлений: по ней сравниваются webhook и polling
+def add_latency_probe(app, bot, mode):
+    async def probe(update, context):
+        message = update.effective_message
+        if message is not None and message.date is not None:
+            latency = max(0.0, time.time() - message.date.timestamp())
+            bot_metrics.observe(UPDATE_LATENCY, latency, bot=bot, mode=mode)
+
+    app.add_handler(TypeHandler(Update, probe), group=-1)
+
+class WebhookBot:
+    def __init__(self, name, app, path, secret, allowed_updates=None):
+        self.name = name
+        self.app = app
+        self.path = path
+        self.secret = secret
+        self.allowed_updates = allowed_updates
+
+class WebhookServer:
+    def __init__(self, host="127.0.0.1", port=8443, url=None, max_connections=40):
+        self.host = host
+        self.port = port
+        # Публичный адрес, который регистрируется в Telegram; None — webhook уже настроен снаружи
+        # (или обновления присылаются вручную при проверке)
+        self.url = url
+        self.max_connections = max_connections
+        self.bots = {}  # путь -> WebhookBot
+
+    def add(self, name, app, secret=None, path=None, allowed_updates=None):
+        path = path or f"/{name}"
+        if path in self.bots:
+            raise ValueError(f"Путь {path} уже занят ботом {self.bots[path].name}")
+        if not secret:
+            # Webhook, настроенный снаружи, и replay должны знать секрет заранее
+            if not self.url:
+                raise ValueError(f"Для {name} без адреса для set_webhook нужно задать секрет")
+            # Случайный секрет на запуск: Telegram получает его в set_webhook и присылает в каждом запросе.
+            # Пишется в лог один раз, чтобы им можно было подписать запросы replay
+            secret = secrets.token_urlsafe(32)
+            logger.info(f"Секрет webhook для {name}: {secret}")
+        self.bots[path] = WebhookBot(name, app, path, secret, allowed_updates)
+        add_latency_probe(app, name, "webhook")
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError("Некорректная строка запроса")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def _dispatch(self, method, target, headers, reader):
+        bot = self.bots.get(target.split("?")[0])
+        length = int(headers.get("content-length") or 0)
+        if length < 0:
+            raise ValueError("Отрицательный Content-Length")
+        if length > MAX_BODY:
+            return 413, bot
+        # Тело читается до любого ответа: иначе при keep-alive оно было бы принято за следующий запрос
+        body = await reader.readexactly(length)
+
+        if bot is None:
+            return 404, None
+        if method != "POST":
+            return 405, bot
+        # Заголовки декодированы как latin-1; сравниваются байты, в str compare_digest не принимает не-ASCII
+        secret = headers.get(SECRET_HEADER.lower(), "").encode("latin-1")
+        if not hmac.compare_digest(secret, bot.secret.encode("utf-8")):
+            return 403, bot
+        try:
+            update = Update.de_json(json.loads(body), bot.app.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Некорректное обновление для {bot.name}: {e}")
+            return 400, bot
+
+        await bot.app.update_queue.put(update)
+        return 200, bot
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                started = time.perf_counter()
+                bot = None
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, target, version, headers = request
+                    status, bot = await self._dispatch(method, target, headers, reader)
+                except ValueError:
+                    # Неразборчивый запрос или Content-Length: соединение дальше не читается
+                    status, keep_alive = 400, False
+                else:
+                    connection = headers.get("connection", "").lower()
+                    keep_alive = (
+                        status != 413
+                        and connection != "close"
+                        and (version == "HTTP/1.1" or connection == "keep-alive")
+                    )
+
+                name = bot.name if bot else "unknown"
+                bot_metrics.inc(WEBHOOK_REQUESTS, bot=name, status=status)
+                bot_metrics.observe(bot_metrics.STAGE_SECONDS, time.perf_counter() - started, bot=name, stage="webhook")
+
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _start_bot(self, bot):
+        app = bot.app
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        if self.url:
+            await app.bot.set_webhook(
+                self.url.rstrip("/") + bot.path,
+                secret_token=bot.secret,
+                allowed_updates=bot.allowed_updates,
+                max_connections=self.max_connections,
+            )
+        await app.start()
+
+    async def _stop_bot(self, bot):
+        app = bot.app
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        initialized = []
+        try:
+            for bot in self.bots.values():
+                initialized.append(bot)
+                await self._start_bot(bot)
+            paths = ", ".join(self.bots)
+            logger.info(f"Webhook слушает http://{self.host}:{self.port} ({paths})")
+            await server.serve_forever()
+        finally:
+            server.close()
+            await server.wait_closed()
+            for bot in reversed(initialized):
+                await self._stop_bot(bot)
+
+def run(server):
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+# ====================== Несколько ботов в одном процессе ======================
+
+def load_bot_module(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), BOT_MODULES[name])
+    # Имя файла arh.m_bot.py не импортируется обычным import
+    spec = importlib.util.spec_from_file_location(f"{name}_bot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_serve(args):
+    if not args.url and not args.secret:
+        sys.exit("Без --url webhook настроен снаружи: укажите --secret")
+    server = WebhookServer(args.listen, args.port, args.url, args.max_connections)
+    for spec in args.bot:
+        name, _, token_file = spec.partition("=")
+        module = load_bot_module(name)
+        with open(token_file or "token.txt") as f:
+            token = f.read().strip()
+        app = module.build_application(token, concurrent_updates=module.WEBHOOK_CONCURRENT_UPDATES)
+        server.add(name, app, secret=args.secret, allowed_updates=module.ALLOWED_UPDATES)
+
+    if args.metrics_port:
+        bot_metrics.start_http_server(args.metrics_port)
+    run(server)
+
+# ====================== Проверка без Telegram ======================
+
+# Отправка записанных обновлений (JSON по одному на строку) на локальный сервер. С --fresh-dates
+# дата сообщения заменяется текущим временем, чтобы update_latency_seconds отражала задержку прогона
+def run_replay(args):
+    latencies = []
+    statuses = {}
+    with open(args.updates, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    for data in updates:
+        if args.fresh_dates:
+            for key in ("message", "edited_message", "channel_post"):
+                if key in data:
+                    data[key]["date"] = time.time()
+        request = urllib.request.Request(
+            args.url,
+            data=json.dumps(data).encode("utf-8"),
+            headers={"Content-Type": "application/json", SECRET_HEADER: args.secret or ""},
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    if latencies:
+        latencies.sort()
+        print(
+            f"updates={len(latencies)} statuses={statuses} "
+            f"p50={latencies[len(latencies) // 2] * 1000:.2f}ms "
+            f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms "
+            f"max={latencies[-1] * 1000:.2f}ms"
+        )
+
+# Заглушка приложения для check: обновления только складываются в очередь
+class _StubApp:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+class _StubWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def _http_request(path, body=b"", secret=None, version="HTTP/1.1", connection=None, length=None):
+    headers = [f"POST {path} {version}", f"Content-Length: {len(body) if length is None else length}"]
+    if secret is not None:
+        headers.append(f"{SECRET_HEADER}: {secret}")
+    if connection:
+        headers.append(f"Connection: {connection}")
+    return ("\r\n".join(headers) + "\r\n\r\n").encode("utf-8") + body
+
+# Один прогон соединения: сырые запросы подряд -> [(статус, Connection)], число принятых обновлений
+async def _run_connection(server, app, raw):
+    reader = asyncio.StreamReader()
+    reader.feed_data(raw)
+    reader.feed_eof()
+    writer = _StubWriter()
+    await server._handle_connection(reader, writer)
+    responses = []
+    for head in writer.data.decode("latin-1").split("\r\n\r\n")[:-1]:
+        lines = head.split("\r\n")
+        headers = dict(line.split(": ", 1) for line in lines[1:])
+        responses.append((int(lines[0].split()[1]), headers["Connection"]))
+    accepted = app.update_queue.qsize()
+    while not app.update_queue.empty():
+        app.update_queue.get_nowait()
+    return responses, accepted
+
+# Разбор запросов _handle_connection без сети и Telegram: статусы, keep-alive и чтение тела
+def run_check(args):
+    server = WebhookServer()
+    app = _StubApp()
+    server.bots["/bot"] = WebhookBot("bot", app, "/bot", "s3cret")
+    update = json.dumps({"update_id": 1}).encode("utf-8")
+    ok_request = _http_request("/bot", update, "s3cret")
+
+    cases = [
+        # имя, сырые запросы, ожидаемые ответы, ожидаемое число принятых обновлений
+        ("keep-alive", ok_request * 3, [(200, "keep-alive")] * 3, 3),
+        ("http/1.0", _http_request("/bot", update, "s3cret", "HTTP/1.0") + ok_request, [(200, "close")], 1),
+        ("connection close", _http_request("/bot", update, "s3cret", connection="close") + ok_request,
+         [(200, "close")], 1),
+        ("bad secret", _http_request("/bot", update, "wrong") + ok_request, [(403, "keep-alive"), (200, "keep-alive")], 1),
+        ("no secret", _http_request("/bot", update) + ok_request, [(403, "keep-alive"), (200, "keep-alive")], 1),
+        ("non-ascii secret", _http_request("/bot", update, "секрет") + ok_request,
+         [(403, "keep-alive"), (200, "keep-alive")], 1),
+        # Тело запроса на чужой путь не должно читаться как следующий запрос
+        ("wrong path", _http_request("/other", update, "s3cret") + ok_request, [(404, "keep-alive"), (200, "keep-alive")], 1),
+        ("bad json", _http_request("/bot", b"{", "s3cret") + ok_request, [(400, "keep-alive"), (200, "keep-alive")], 1),
+        ("too large", _http_request("/bot", secret="s3cret", length=MAX_BODY + 1) + ok_request, [(413, "close")], 0),
+        ("bad length", _http_request("/bot", secret="s3cret", length="abc") + ok_request, [(400, "close")], 0),
+    ]
+
+    failed = 0
+    for name, raw, expected, expected_accepted in cases:
+        responses, accepted = asyncio.run(_run_connection(server, app, raw))
+        ok = responses == expected and accepted == expected_accepted
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: ответы={responses} принято={accepted}")
+    return 1 if failed else 0
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Webhook-сервер для ботов и проверка записанными обновлениями")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="запустить боты в режиме webhook в одном процессе")
+    serve.add_argument(
+        "--bot", action="append", required=True, metavar="NAME[=TOKEN_FILE]",
+        help=f"бот ({', '.join(BOT_MODULES)}) и файл с его токеном; можно указать несколько раз"
+    )
+    serve.add_argument("--listen", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8443)
+    serve.add_argument("--url", help="публичный адрес для set_webhook; без него webhook не регистрируется")
+    serve.add_argument(
+        "--secret",
+        help="секрет для всех ботов; обязателен без --url, иначе по умолчанию случайный на запуск (пишется в лог)"
+    )
+    serve.add_argument("--max-connections", type=int, default=40, help="одновременных запросов от Telegram")
+    serve.add_argument("--metrics-port", type=int)
+
+    replay = commands.add_parser("replay", help="отправить записанные обновления на локальный сервер")
+    replay.add_argument("url", help="например http://127.0.0.1:8443/phonestat")
+    replay.add_argument("updates", help="файл с обновлениями Telegram, по одному JSON на строку")
+    replay.add_argument("--secret")
+    replay.add_argument("--fresh-dates", action="store_true", help="заменить даты сообщений текущим временем")
+
+    commands.add_parser("check", help="проверить разбор запросов сервером на заглушке приложения")
+    return parser.parse_args(argv)
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    args = parse_args(sys.argv[1:])
+    if args.command == "serve":
+        run_serve(args)
+    elif args.command == "check":
+        return run_check(args)
+    else:
+        run_replay(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
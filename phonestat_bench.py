@@ -0,0 +1,450 @@
+import os
+import sys
+import re
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import zipfile
+import shutil
+import tracemalloc
+from types import SimpleNamespace
+
+import phonestat_bot
+
+MB = 1024 * 1024
+
+# ====================== Генератор синтетических bugreport ======================
+
+# Строки-шум: logcat с кириллицей и битыми байтами, которые не декодируются в UTF-8
+def make_noise_pool(rng, count=2000):
+    tags = [b"ActivityManager", b"WindowManager", b"chatty", b"NetworkMonitor", b"\xd0\x9b\xd0\xbe\xd0\xb3"]
+    pool = []
+    for i in range(count):
+        line = b"%02d-%02d %02d:%02d:%02d.%03d %5d %5d I %s: " % (
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59),
+            rng.randint(0, 59), rng.randint(0, 999), rng.randint(1, 30000), rng.randint(1, 30000),
+            rng.choice(tags)
+        )
+        line += b"event %d value=%d state=" % (i, rng.randint(0, 10 ** 6))
+        if i % 7 == 0:
+            line += b"\xff\xfe\xc3(\xa0\xa1 broken \xe2\x82"
+        else:
+            line += rng.choice([b"ok", b"\xd0\xbf\xd1\x80\xd0\xb8\xd0\xb2\xd0\xb5\xd1\x82", b"idle", b"busy"])
+        pool.append(line + b"\n")
+    return pool
+
+def write_noise(f, pool, rng, size):
+    written = 0
+    while written < size:
+        chunk = b"".join(rng.choice(pool) for _ in range(256))
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+# Секция dumpsys batterystats: расход по uid и сводка partial wakelock, uids приложений на каждую
+def batterystats_block(uids, rng):
+    lines = [
+        b"DUMP OF SERVICE batterystats:\n",
+        b"Statistics since last charge:\n",
+        b"  Estimated power use (mAh):\n",
+        b"    Capacity: 4500, Computed drain: 1520, actual drain: 1400-1600\n",
+    ]
+    for i in range(uids):
+        lines.append(b"    UID u0a%d: %.2f ( cpu=%.2f wake=%.3f )\n" % (i, rng.random() * 50, rng.random(), rng.random()))
+    lines.append(b"  All partial wake locks:\n")
+    for i in range(uids):
+        ms = rng.randint(0, 10 ** 7)
+        lines.append(
+            b"  Wake lock u0a%d *job*/com.example.app%d/.SyncService: %dh %dm %ds %dms (%d times) realtime\n"
+            % (i, i, ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000, rng.randint(1, 500))
+        )
+    return b"".join(lines)
+
+def target_block(accounts):
+    lines = [
+        b"------ KERNEL LOG (dmesg) ------\n",
+        b'[    0.000000] androidboot.hardware.ddr = "8GB", "LPDDR5", "Hynix"\n',
+        b'[    0.000000] androidboot.hardware.ufs = "256GB", "Samsung"\n',
+        b"[  120.500000] healthd: battery l=80 v=4012 t=30.1 h=2 st=3 c=-210 fc=4500000 cc=317 chg=\n",
+        b"------ 0.051s was the duration of 'KERNEL LOG' ------\n",
+        b"DUMP OF SERVICE display:\n",
+        b"  mPhysicalDisplayId=4619827259835644672\n",
+        b"  mActiveSfDisplayMode=DisplayMode{id=0, width=1080, height=2400, xDpi=409.432, yDpi=411.891, refreshRate=120.0}\n",
+        b"  mSupportedRefreshRates=[60.0, 90.0, 120.0, 120.00001]\n",
+        b"  deviceProductInfo=DeviceProductInfo{name=, manufacturerPnpId=SDC, productId=4, "
+        b"modelYear=null, manufactureDate=ManufactureDate{week=27, year=2021}}\n",
+        b"  mNits=[2.0, 500.0, 1000.5]\n",
+        b"DUMP OF SERVICE dreams:\n",
+        b"  mDreamsBatteryLevelDrain=7\n",
+        b"DUMP OF SERVICE account:\n",
+        b"User UserInfo{0:Owner:c13}:\n",
+        b"  Accounts: %d\n" % accounts,
+    ]
+    for i in range(accounts):
+        lines.append(b"    Account {name=user%d@gmail.com, type=com.google}\n" % i)
+        if i % 10 == 0:
+            lines.append(b"    Account {name=device%d, type=com.xiaomi}\n" % i)
+    return b"".join(lines)
+
+# Синтетический отчёт заданного размера; блок с искомыми полями начинается на глубине depth (0..1)
+def generate_bugreport(path, size, depth=0.5, accounts=100, seed=1, uids=1000):
+    rng = random.Random(seed)
+    pool = make_noise_pool(rng)
+    block = target_block(accounts) + batterystats_block(uids, rng)
+
+    with open(path, "wb") as f:
+        f.write(
+            b"========================================================\n"
+            b"== dumpstate: 2024-05-01 10:00:00\n"
+            b"========================================================\n\n"
+            b"Build: UKQ1.231003.002\n"
+            b"Build fingerprint: 'Xiaomi/synthetic/synthetic:14/UKQ1.231003.002/V816:user/release-keys'\n\n"
+            b"------ SYSTEM LOG (logcat -v threadtime -d *:v) ------\n"
+        )
+        before = max(0, int(size * depth) - f.tell())
+        write_noise(f, pool, rng, before)
+        f.write(block)
+        f.write(b"DUMP OF SERVICE activity:\n")
+        write_noise(f, pool, rng, max(0, size - f.tell()))
+    return path
+
+def make_zip(report_path, zip_path):
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.write(report_path, "bugreport-synthetic-UKQ1.231003.002-2024-05-01-10-00-00.txt")
+    return zip_path
+
+# ====================== Эталон: прежний построчный разбор ======================
+
+# Замороженная копия parse_log_file до перехода на общий шаблон; не менять. Сравниваются только поля,
+# которые он заполнял. Известное расхождение: строка с manufacturerPnpId содержит и ManufactureDate,
+# а цепочка elif после совпадения производителя дату не проверяла — новый разбор её находит
+LEGACY_DIFFERENCES = {"manufacture_date"}
+
+def legacy_parse_log_file(file):
+    data = {
+        "capacity": "Не найдено",
+        "cycles": "Не найдено",
+        "build": "Не найдено",
+        "ram": "Не найдено",
+        "rom": "Не найдено",
+        "display_id": "Не найдено",
+        "resolution": "Не найдено",
+        "dpi": "Не найдено",
+        "refresh_rates": "Не найдено",
+        "manufacturer": "Не найдено",
+        "manufacture_date": "Не найдено",
+        "brightness": "Не найдено",
+        "battery_health": "Не найдено",
+        "accounts": []
+    }
+    
+    # Регулярные выражения для поиска данных
+    patterns = {
+        "healthd": re.compile(r'healthd:.*fc=(\d+).*cc=(\d+)'),
+        "build": re.compile(r'Build:\s*([^\s]+)'),
+        "ram": re.compile(r'androidboot\.hardware\.ddr\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"\s*,\s*"([^"]+)"'),
+        "rom": re.compile(r'androidboot\.hardware\.ufs\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"'),
+        "display_id": re.compile(r'mPhysicalDisplayId=(\d+)'),
+        "resolution": re.compile(r'mActiveSfDisplayMode=.*?width=(\d+), height=(\d+)'),
+        "dpi": re.compile(r'mActiveSfDisplayMode=.*?xDpi=([\d.]+), yDpi=([\d.]+)'),
+        "refresh_rates": re.compile(r'mSupportedRefreshRates=\[([\d\., ]+)\]'),
+        "manufacturer": re.compile(r'manufacturerPnpId=(\w+)'),
+        "manufacture_date": re.compile(r'ManufactureDate\{week=(\d+), year=(\d+)\}'),
+        "brightness": re.compile(r'mNits=\[([\d\., ]+)\]'),
+        "battery_drain": re.compile(r'mDreamsBatteryLevelDrain=(-?\d+)'),
+        "account": re.compile(r'Account\s*\{name=([^,]+?),\s*type=([^\}]+?)\}')
+    }
+
+    # Множество для отслеживания уникальных аккаунтов
+    seen_accounts = set()
+
+    # Построчная обработка файла
+    for line in file:
+        try:
+            # Декодирование с обработкой ошибок
+            line_str = line.decode('utf-8', errors='ignore')
+        except AttributeError:
+            line_str = line
+            
+        # Поиск данных в строке
+        if "healthd" in line_str and data["capacity"] == "Не найдено":
+            match = patterns["healthd"].search(line_str)
+            if match:
+                capacity = match.group(1)
+                # Удаляем три нуля с конца и добавляем mAh
+                if capacity.endswith('000'):
+                    capacity = capacity[:-3] + "mAh"
+                else:
+                    capacity += "mAh"
+                data["capacity"] = capacity
+                data["cycles"] = match.group(2)
+        
+        elif "mDreamsBatteryLevelDrain" in line_str and data["battery_health"] == "Не найдено":
+            match = patterns["battery_drain"].search(line_str)
+            if match:
+                drain = int(match.group(1))
+                health = 100 - drain
+                data["battery_health"] = f"{health}%"
+                
+        elif "Build:" in line_str and data["build"] == "Не найдено":
+            match = patterns["build"].search(line_str)
+            if match:
+                data["build"] = match.group(1)
+                
+        elif "androidboot.hardware.ddr" in line_str and data["ram"] == "Не найдено":
+            match = patterns["ram"].search(line_str)
+            if match:
+                data["ram"] = f"{match.group(1)}, {match.group(2)}, {match.group(3)}"
+                
+        elif "androidboot.hardware.ufs" in line_str and data["rom"] == "Не найдено":
+            match = patterns["rom"].search(line_str)
+            if match:
+                data["rom"] = f"{match.group(1)}, {match.group(2)}"
+                
+        elif "Account {" in line_str:
+            match = patterns["account"].search(line_str)
+            if match:
+                account_name = match.group(1).strip()
+                account_type = match.group(2).strip()
+                
+                # Фильтрация аккаунтов по наличию '@' и удаление дубликатов
+                if '@' in account_name:
+                    account_id = f"{account_name.lower()}|{account_type.lower()}"
+                    if account_id not in seen_accounts:
+                        seen_accounts.add(account_id)
+                        data["accounts"].append((account_name, account_type))
+        
+        elif "mPhysicalDisplayId" in line_str and data["display_id"] == "Не найдено":
+            match = patterns["display_id"].search(line_str)
+            if match:
+                data["display_id"] = match.group(1)
+                
+        elif "mActiveSfDisplayMode" in line_str and data["resolution"] == "Не найдено":
+            match_res = patterns["resolution"].search(line_str)
+            match_dpi = patterns["dpi"].search(line_str)
+            
+            if match_res:
+                data["resolution"] = f"{match_res.group(1)}x{match_res.group(2)}"
+                
+            if match_dpi:
+                x_dpi = float(match_dpi.group(1))
+                y_dpi = float(match_dpi.group(2))
+                # Рассчет DPI по формуле √(xDpi^2 + yDpi^2)
+                dpi_value = round((x_dpi**2 + y_dpi**2)**0.5)
+                data["dpi"] = str(dpi_value)
+                
+        elif "mSupportedRefreshRates" in line_str and data["refresh_rates"] == "Не найдено":
+            match = patterns["refresh_rates"].search(line_str)
+            if match:
+                rates = [rate.strip() for rate in match.group(1).split(',')]
+                # Фильтрация уникальных частот и преобразование в целые
+                unique_rates = []
+                for rate in rates:
+                    try:
+                        # Преобразование в float и округление до целого
+                        rate_value = str(int(float(rate)))
+                        if rate_value not in unique_rates:
+                            unique_rates.append(rate_value)
+                    except ValueError:
+                        continue
+                data["refresh_rates"] = ", ".join(unique_rates) + " Hz"
+                
+        elif "manufacturerPnpId" in line_str and data["manufacturer"] == "Не найдено":
+            match = patterns["manufacturer"].search(line_str)
+            if match:
+                data["manufacturer"] = match.group(1)
+                
+        elif "ManufactureDate" in line_str and data["manufacture_date"] == "Не найдено":
+            match = patterns["manufacture_date"].search(line_str)
+            if match:
+                data["manufacture_date"] = f"{match.group(2)} г."
+                
+        elif "mNits" in line_str and data["brightness"] == "Не найдено":
+            match = patterns["brightness"].search(line_str)
+            if match:
+                nits = [float(nit.strip()) for nit in match.group(1).split(',')]
+                if nits:
+                    # Берем максимальное значение яркости
+                    max_brightness = max(nits)
+                    data["brightness"] = f"{int(max_brightness)} Nit"
+                
+    return data
+
+# ====================== Замеры ======================
+
+# Память по этапам analyze_zip_path (zip_open, unzip, parse) в текущем процессе под tracemalloc
+def bench_zip_memory(zip_path, work_dir):
+    memory = {}
+    tracemalloc.start()
+    try:
+        phonestat_bot.analyze_zip_path(zip_path, work_dir, memory=memory)
+    finally:
+        tracemalloc.stop()
+    return memory
+
+# Совпадение с прежним разбором по его полям; в LEGACY_DIFFERENCES прежний мог не найти значение
+def matches_legacy(result, legacy):
+    for field, value in legacy.items():
+        if field in LEGACY_DIFFERENCES and value == phonestat_bot.NOT_FOUND:
+            continue
+        if result[field] != value:
+            return False
+    return True
+
+def bench_parse(path):
+    size = os.path.getsize(path)
+    phonestat_bot.reset_extractor_stats()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        stream_result = phonestat_bot.parse_log_file(f)
+    stream_time = time.perf_counter() - start
+    # Время и срабатывания каждого извлекателя при потоковом разборе
+    fields = phonestat_bot.extractor_stats()
+
+    start = time.perf_counter()
+    mmap_result = phonestat_bot.parse_mapped_file(path)
+    mmap_time = time.perf_counter() - start
+
+    # Эталон: прежний построчный разбор
+    with open(path, "rb") as f:
+        legacy_result = legacy_parse_log_file(f)
+
+    # Отдельный проход под tracemalloc, чтобы не искажать время
+    tracemalloc.start()
+    phonestat_bot.parse_mapped_file(path)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "stream_mb_s": size / MB / stream_time,
+        "mmap_mb_s": size / MB / mmap_time,
+        "traced_peak_mb": traced_peak / MB,
+        "match": stream_result == mmap_result and matches_legacy(stream_result, legacy_result),
+        "fields": fields,
+    }
+
+# Заглушки Telegram для прогона handle_zip без сети
+class FakeFile:
+    def __init__(self, path):
+        self.path = path
+
+    async def download_to_drive(self, custom_path):
+        shutil.copyfile(self.path, custom_path)
+
+    async def download_to_memory(self, out):
+        with open(self.path, "rb") as f:
+            shutil.copyfileobj(f, out)
+
+class FakeMessage:
+    def __init__(self, document):
+        self.document = document
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    # Заглушка с промежуточными результатами правится на месте
+    async def edit_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+class FakeBot:
+    def __init__(self, path):
+        self.path = path
+
+    async def get_file(self, document):
+        return FakeFile(self.path)
+
+async def run_handle_zip(zip_path, runs):
+    durations = []
+    for i in range(runs):
+        # Новый file_unique_id и пустой кеш, чтобы каждый прогон был полным
+        phonestat_bot.result_cache = phonestat_bot.ResultCache(cache_dir=None)
+        document = SimpleNamespace(file_name="bugreport.zip", file_unique_id=f"bench-{i}")
+        message = FakeMessage(document)
+        update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=i))
+        context = SimpleNamespace(bot=FakeBot(zip_path))
+
+        start = time.perf_counter()
+        await phonestat_bot.handle_zip(update, context)
+        durations.append(time.perf_counter() - start)
+        if not message.replies or not message.replies[-1].startswith("🔍"):
+            raise RuntimeError(f"handle_zip вернул ошибку: {message.replies}")
+
+    if phonestat_bot.parse_queue is not None:
+        phonestat_bot.parse_queue.shutdown()
+        phonestat_bot.parse_queue = None
+    return min(durations)
+
+def bench_handle_zip(report_path, zip_path, runs):
+    # История устройств не пишется, чтобы замер не зависел от диска
+    phonestat_bot.HISTORY_DB = None
+    size = os.path.getsize(report_path)
+    best = asyncio.run(run_handle_zip(zip_path, runs))
+    return {"handle_zip_s": best, "handle_zip_mb_s": size / MB / best}
+
+# ====================== Запуск ======================
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора bugreport для phonestat_bot")
+    parser.add_argument("--sizes", default="10,100", help="размеры отчётов в МБ через запятую (до 1024)")
+    parser.add_argument("--depths", default="0.05,0.5,0.95", help="глубина блока с полями (0..1)")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--uids", type=int, default=1000, help="приложений и wakelock в batterystats")
+    parser.add_argument("--runs", type=int, default=3, help="прогонов handle_zip на отчёт")
+    parser.add_argument("--no-zip", action="store_true", help="не замерять полный путь handle_zip")
+    parser.add_argument("--workdir", default=None, help="каталог для сгенерированных файлов")
+    parser.add_argument(
+        "--memory-ceiling", type=float, default=64,
+        help="потолок пика tracemalloc на этап в МБ; при превышении код возврата 1"
+    )
+    args = parser.parse_args()
+
+    sizes = [float(s) for s in args.sizes.split(",")]
+    depths = [float(d) for d in args.depths.split(",")]
+
+    over_ceiling = []
+    with tempfile.TemporaryDirectory(prefix="phonestat_bench_", dir=args.workdir) as work_dir:
+        for size in sizes:
+            for depth in depths:
+                report = os.path.join(work_dir, "bugreport.txt")
+                generate_bugreport(report, int(size * MB), depth=depth, accounts=args.accounts, uids=args.uids)
+                result = bench_parse(report)
+
+                line = (
+                    f"size={size:g}MB depth={depth:g} accounts={args.accounts} uids={args.uids} "
+                    f"stream={result['stream_mb_s']:.1f}MB/s mmap={result['mmap_mb_s']:.1f}MB/s "
+                    f"traced_peak={result['traced_peak_mb']:.1f}MB "
+                    f"match={'yes' if result['match'] else 'NO'}"
+                )
+                peaks = {"parse_log_file": result["traced_peak_mb"]}
+                if not args.no_zip:
+                    zip_path = make_zip(report, os.path.join(work_dir, "bugreport.zip"))
+                    zip_result = bench_handle_zip(report, zip_path, args.runs)
+                    line += f" handle_zip={zip_result['handle_zip_s']:.3f}s ({zip_result['handle_zip_mb_s']:.1f}MB/s)"
+                    memory = bench_zip_memory(zip_path, work_dir)
+                    peaks.update((stage, m["traced_peak"] / MB) for stage, m in memory.items())
+                    line += "\n    memory: " + phonestat_bot.format_memory_report(memory)
+                print(line)
+                for stage, peak in peaks.items():
+                    if peak > args.memory_ceiling:
+                        over_ceiling.append(f"size={size:g}MB depth={depth:g} {stage}: {peak:.1f}MB")
+
+                fields = ", ".join(
+                    f"{name}={seconds * 1000:.2f}ms/{hits}"
+                    for name, (hits, seconds) in sorted(result["fields"].items(), key=lambda item: -item[1][1])
+                )
+                print(f"    fields: {fields}")
+        print(f"peak_rss={phonestat_bot._format_mb(phonestat_bot._rss_peak_bytes())}MB")
+
+    if over_ceiling:
+        print(f"Превышен потолок памяти {args.memory_ceiling:g}MB:", file=sys.stderr)
+        for entry in over_ceiling:
+            print(f"    {entry}", file=sys.stderr)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,27 @@
 import os
+import sys
 import re
+import csv
+import glob
+import argparse
+import json
+import time
+import hashlib
+import heapq
+import logging
+import tracemalloc
+import asyncio
 import zipfile
 import io
+import mmap
+import tempfile
+import queue
+import multiprocessing
+import sqlite3
+from datetime import datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -10,185 +30,593 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters
 )
+from telegram.error import TelegramError
 
-# Функция для извлечения информации из лог-файла
-def parse_log_file(file):
-    data = {
-        "capacity": "Не найдено",
-        "cycles": "Не найдено",
-        "build": "Не найдено",
-        "ram": "Не найдено",
-        "rom": "Не найдено",
-        "display_id": "Не найдено",
-        "resolution": "Не найдено",
-        "dpi": "Не найдено",
-        "refresh_rates": "Не найдено",
-        "manufacturer": "Не найдено",
-        "manufacture_date": "Не найдено",
-        "brightness": "Не найдено",
-        "battery_health": "Не найдено",
-        "accounts": []
-    }
-    
-    # Регулярные выражения для поиска данных
-    patterns = {
-        "healthd": re.compile(r'healthd:.*fc=(\d+).*cc=(\d+)'),
-        "build": re.compile(r'Build:\s*([^\s]+)'),
-        "ram": re.compile(r'androidboot\.hardware\.ddr\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"\s*,\s*"([^"]+)"'),
-        "rom": re.compile(r'androidboot\.hardware\.ufs\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"'),
-        "display_id": re.compile(r'mPhysicalDisplayId=(\d+)'),
-        "resolution": re.compile(r'mActiveSfDisplayMode=.*?width=(\d+), height=(\d+)'),
-        "dpi": re.compile(r'mActiveSfDisplayMode=.*?xDpi=([\d.]+), yDpi=([\d.]+)'),
-        "refresh_rates": re.compile(r'mSupportedRefreshRates=\[([\d\., ]+)\]'),
-        "manufacturer": re.compile(r'manufacturerPnpId=(\w+)'),
-        "manufacture_date": re.compile(r'ManufactureDate\{week=(\d+), year=(\d+)\}'),
-        "brightness": re.compile(r'mNits=\[([\d\., ]+)\]'),
-        "battery_drain": re.compile(r'mDreamsBatteryLevelDrain=(-?\d+)'),
-        "account": re.compile(r'Account\s*\{name=([^,]+?),\s*type=([^\}]+?)\}')
-    }
+import bot_metrics
+import bot_webhook
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = "Не найдено"
+MB = 1024 * 1024
+
+# Обработка архивов через временные файлы на диске и mmap вместо буфера в памяти
+DISK_MODE = True
+TEMP_DIR = None  # None — системный каталог для временных файлов
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Пул процессов для распаковки и разбора логов
+PARSE_WORKERS = os.cpu_count() or 1
+MAX_QUEUED_JOBS = 20  # Всего задач: скачивание + ожидание + разбор
+MAX_JOBS_PER_USER = 1
+
+# Кеш результатов разбора: по file_unique_id Telegram и по хешу содержимого архива
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL = 7 * 24 * 3600  # секунды
+CACHE_DIR = None  # Каталог дискового кеша; None — только кеш в памяти
+CACHE_DIR_MAX_BYTES = 256 * MB  # При превышении удаляются самые старые файлы дискового кеша
+
+# Лимиты разбора одного отчёта в боте: по их исчерпании возвращается частичный результат
+PARSE_TIME_BUDGET = 60  # секунды; None — без ограничения
+PARSE_BYTE_BUDGET = None  # байт распакованного лога; None — без ограничения
+# Промежуточные результаты: как часто проверять прогресс и не чаще какого интервала править сообщение
+PROGRESS_POLL_INTERVAL = 0.5
+EDIT_INTERVAL = 3.0
+
+# Режим webhook: порт локального сервера; None — получать обновления через run_polling
+WEBHOOK_PORT = None
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_URL = None  # Публичный адрес для set_webhook; None — webhook настроен снаружи
+# Секрет в заголовке запросов Telegram. None — случайный на каждый запуск (пишется в лог);
+# без WEBHOOK_URL обязателен, иначе бот не запустится
+WEBHOOK_SECRET = None
+WEBHOOK_CONCURRENT_UPDATES = 16  # Обновлений, обрабатываемых одновременно в режиме webhook
+ALLOWED_UPDATES = None  # Типы обновлений по умолчанию
+
+# История анализов по устройствам (SQLite); None — не сохранять
+HISTORY_DB = "history.sqlite3"
+HISTORY_LIMIT = 10  # Сколько последних отчётов показывать в /history
+
+# Проверки архива до распаковки по размерам из центрального каталога
+MAX_LOG_SIZE = 2 * 1024 ** 3  # Заявленный размер выбранного лога или вложенного архива
+MAX_COMPRESSION_RATIO = 100  # Текст bugreport сжимается в 10–20 раз
+MAX_ARCHIVE_MEMBERS = 100000
+MAX_NESTING = 2  # Глубина вложенных ZIP, в которых ищется лог
+MAIN_ENTRY = "main_entry.txt"
+
+# Профиль памяти по этапам задачи (tracemalloc + RSS) в логе; замедляет разбор, включать для диагностики
+MEMORY_PROFILE = False
+
+# Локальный порт для метрик в формате Prometheus (/metrics); None — не запускать
+METRICS_PORT = None
+# Срабатывания ключевых слов извлекателей; время разбора их строк идёт в stage="extract_<имя>"
+EXTRACTOR_HITS = "extractor_hits_total"
 
-    # Множество для отслеживания уникальных аккаунтов
-    seen_accounts = set()
+# Размер блока при чтении потока (z.open); блок обрезается по последнему переводу строки
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
 
-    # Построчная обработка файла
-    for line in file:
+# Начало файла до первой секции (там находится строка Build:)
+HEADER_SECTION = "HEADER"
+# Маркер начала секции dumpsys; список закрывается, когда после его секции начинается следующая
+SERVICE_MARKER = b"DUMP OF SERVICE "
+# Сколько самых затратных приложений и wakelock показывать из batterystats
+TOP_K = 10
+
+# Наибольшие k значений в куче фиксированного размера. Для повторяющегося ключа берётся максимум:
+# вытесненный ключ уступил k большим значениям и с тем же значением в кучу уже не вернётся
+class TopK:
+    def __init__(self, k):
+        self.k = k
+        self.heap = []  # (значение, ключ, элемент)
+        self.values = {}  # ключ -> значение в куче, не больше k записей
+
+    # Возвращает True, если набор лидеров изменился
+    def add(self, key, value, item):
+        current = self.values.get(key)
+        if current is not None:
+            if value <= current:
+                return False
+            self.heap = [entry for entry in self.heap if entry[1] != key]
+            heapq.heapify(self.heap)
+        elif len(self.heap) >= self.k:
+            if value <= self.heap[0][0]:
+                return False
+            _, evicted, _ = heapq.heappop(self.heap)
+            del self.values[evicted]
+        heapq.heappush(self.heap, (value, key, item))
+        self.values[key] = value
+        return True
+
+    def items(self):
+        return [item for _, _, item in sorted(self.heap, reverse=True)]
+
+# Описание извлекаемого значения: ключевое слово (или несколько) для общего шаблона, регулярное
+# выражение, постобработка совпадения и поля, которые оно заполняет, вместе с подписями для отчёта.
+# multi=True — открытый список (аккаунты), собираемый до конца первой из своих секций.
+# top=k — список k наибольших значений; ищется только внутри своей секции, память не растёт
+# с размером секции. render — текст одного элемента списка.
+class Extractor:
+    def __init__(self, name, keyword, pattern, convert, fields, group, sections=(), multi=False, key=None,
+                 top=None, render=None):
+        self.name = name
+        self.keywords = keyword if isinstance(keyword, tuple) else (keyword,)
+        self.pattern = re.compile(pattern)
+        self.convert = convert
+        self.fields = fields  # [(поле, подпись)]; подпись None — поле не выводится отдельной строкой
+        self.group = group
+        self.sections = sections
+        self.multi = multi or top is not None
+        self.key = key  # Ключ удаления дубликатов для списков
+        self.top = top
+        self.render = render
+        self.section_header = SERVICE_MARKER + sections[0].encode() + b":" if self.multi else None
+        # Счётчики: сколько раз сработало ключевое слово и сколько времени ушло на разбор строк
+        self.hits = 0
+        self.seconds = 0.0
+
+    @property
+    def field(self):
+        return self.fields[0][0]
+
+    def extract(self, line, data, state):
+        self.hits += 1
+        started = time.perf_counter()
+        match = self.pattern.search(line)
+        if match:
+            value = self.convert(match)
+            if self.top is not None:
+                if value is not None:
+                    aggregator = state["top"].get(self.name)
+                    if aggregator is None:
+                        aggregator = state["top"][self.name] = TopK(self.top)
+                    if aggregator.add(*value):
+                        data[self.field] = aggregator.items()
+            elif self.multi:
+                if value is not None:
+                    item_key = self.key(value)
+                    seen = state["seen"].setdefault(self.name, set())
+                    if item_key not in seen:
+                        seen.add(item_key)
+                        data[self.field].append(value)
+            else:
+                data.update(value)
+        self.seconds += time.perf_counter() - started
+
+# Декодируются только найденные значения, а не каждая строка
+def _text(value):
+    return value.decode('utf-8', errors='ignore')
+
+def _convert_healthd(match):
+    capacity = _text(match.group(1))
+    # Удаляем три нуля с конца и добавляем mAh
+    if capacity.endswith('000'):
+        capacity = capacity[:-3] + "mAh"
+    else:
+        capacity += "mAh"
+    return {"capacity": capacity, "cycles": _text(match.group(2))}
+
+def _convert_battery_drain(match):
+    drain = int(match.group(1))
+    health = 100 - drain
+    return {"battery_health": f"{health}%"}
+
+def _convert_display_mode(match):
+    values = {}
+    if match.group(1) is not None:
+        values["resolution"] = f"{_text(match.group(1))}x{_text(match.group(2))}"
+    if match.group(3) is not None:
+        x_dpi = float(match.group(3))
+        y_dpi = float(match.group(4))
+        # Рассчет DPI по формуле √(xDpi^2 + yDpi^2)
+        values["dpi"] = str(round((x_dpi**2 + y_dpi**2)**0.5))
+    return values
+
+def _convert_refresh_rates(match):
+    rates = [rate.strip() for rate in match.group(1).split(b',')]
+    # Фильтрация уникальных частот и преобразование в целые
+    unique_rates = []
+    for rate in rates:
         try:
-            # Декодирование с обработкой ошибок
-            line_str = line.decode('utf-8', errors='ignore')
-        except AttributeError:
-            line_str = line
-            
-        # Поиск данных в строке
-        if "healthd" in line_str and data["capacity"] == "Не найдено":
-            match = patterns["healthd"].search(line_str)
-            if match:
-                capacity = match.group(1)
-                # Удаляем три нуля с конца и добавляем mAh
-                if capacity.endswith('000'):
-                    capacity = capacity[:-3] + "mAh"
-                else:
-                    capacity += "mAh"
-                data["capacity"] = capacity
-                data["cycles"] = match.group(2)
-        
-        elif "mDreamsBatteryLevelDrain" in line_str and data["battery_health"] == "Не найдено":
-            match = patterns["battery_drain"].search(line_str)
-            if match:
-                drain = int(match.group(1))
-                health = 100 - drain
-                data["battery_health"] = f"{health}%"
-                
-        elif "Build:" in line_str and data["build"] == "Не найдено":
-            match = patterns["build"].search(line_str)
-            if match:
-                data["build"] = match.group(1)
-                
-        elif "androidboot.hardware.ddr" in line_str and data["ram"] == "Не найдено":
-            match = patterns["ram"].search(line_str)
-            if match:
-                data["ram"] = f"{match.group(1)}, {match.group(2)}, {match.group(3)}"
-                
-        elif "androidboot.hardware.ufs" in line_str and data["rom"] == "Не найдено":
-            match = patterns["rom"].search(line_str)
-            if match:
-                data["rom"] = f"{match.group(1)}, {match.group(2)}"
-                
-        elif "Account {" in line_str:
-            match = patterns["account"].search(line_str)
-            if match:
-                account_name = match.group(1).strip()
-                account_type = match.group(2).strip()
-                
-                # Фильтрация аккаунтов по наличию '@' и удаление дубликатов
-                if '@' in account_name:
-                    account_id = f"{account_name.lower()}|{account_type.lower()}"
-                    if account_id not in seen_accounts:
-                        seen_accounts.add(account_id)
-                        data["accounts"].append((account_name, account_type))
-        
-        elif "mPhysicalDisplayId" in line_str and data["display_id"] == "Не найдено":
-            match = patterns["display_id"].search(line_str)
-            if match:
-                data["display_id"] = match.group(1)
-                
-        elif "mActiveSfDisplayMode" in line_str and data["resolution"] == "Не найдено":
-            match_res = patterns["resolution"].search(line_str)
-            match_dpi = patterns["dpi"].search(line_str)
-            
-            if match_res:
-                data["resolution"] = f"{match_res.group(1)}x{match_res.group(2)}"
-                
-            if match_dpi:
-                x_dpi = float(match_dpi.group(1))
-                y_dpi = float(match_dpi.group(2))
-                # Рассчет DPI по формуле √(xDpi^2 + yDpi^2)
-                dpi_value = round((x_dpi**2 + y_dpi**2)**0.5)
-                data["dpi"] = str(dpi_value)
-                
-        elif "mSupportedRefreshRates" in line_str and data["refresh_rates"] == "Не найдено":
-            match = patterns["refresh_rates"].search(line_str)
-            if match:
-                rates = [rate.strip() for rate in match.group(1).split(',')]
-                # Фильтрация уникальных частот и преобразование в целые
-                unique_rates = []
-                for rate in rates:
-                    try:
-                        # Преобразование в float и округление до целого
-                        rate_value = str(int(float(rate)))
-                        if rate_value not in unique_rates:
-                            unique_rates.append(rate_value)
-                    except ValueError:
-                        continue
-                data["refresh_rates"] = ", ".join(unique_rates) + " Hz"
-                
-        elif "manufacturerPnpId" in line_str and data["manufacturer"] == "Не найдено":
-            match = patterns["manufacturer"].search(line_str)
-            if match:
-                data["manufacturer"] = match.group(1)
-                
-        elif "ManufactureDate" in line_str and data["manufacture_date"] == "Не найдено":
-            match = patterns["manufacture_date"].search(line_str)
-            if match:
-                data["manufacture_date"] = f"{match.group(2)} г."
-                
-        elif "mNits" in line_str and data["brightness"] == "Не найдено":
-            match = patterns["brightness"].search(line_str)
-            if match:
-                nits = [float(nit.strip()) for nit in match.group(1).split(',')]
-                if nits:
-                    # Берем максимальное значение яркости
-                    max_brightness = max(nits)
-                    data["brightness"] = f"{int(max_brightness)} Nit"
-                
+            # Преобразование в float и округление до целого
+            rate_value = str(int(float(rate)))
+            if rate_value not in unique_rates:
+                unique_rates.append(rate_value)
+        except ValueError:
+            continue
+    return {"refresh_rates": ", ".join(unique_rates) + " Hz"}
+
+def _convert_brightness(match):
+    nits = [float(nit.strip()) for nit in match.group(1).split(b',')]
+    # Берем максимальное значение яркости
+    return {"brightness": f"{int(max(nits))} Nit"}
+
+def _convert_account(match):
+    account_name = _text(match.group(1)).strip()
+    account_type = _text(match.group(2)).strip()
+    # Фильтрация аккаунтов по наличию '@'
+    if '@' in account_name:
+        return (account_name, account_type)
+    return None
+
+DURATION_PART = re.compile(rb'(\d+)(ms|d|h|m|s)')
+DURATION_SECONDS = {b"d": 86400, b"h": 3600, b"m": 60, b"s": 1, b"ms": 0.001}
+
+# "Uid u0a123: 45.6 ( cpu=... )" из "Estimated power use (mAh)"
+def _convert_power_use(match):
+    uid = _text(match.group(1))
+    mah = float(match.group(2))
+    return uid, mah, (uid, mah)
+
+# "Wake lock u0a123 *alarm*: 1h 2m 3s 400ms (120 times) realtime" из "All partial wake locks"
+def _convert_wakelock(match):
+    uid = _text(match.group(1))
+    name = _text(match.group(2))
+    seconds = sum(int(number) * DURATION_SECONDS[unit] for number, unit in DURATION_PART.findall(match.group(3)))
+    return f"{uid}|{name}", seconds, (name, uid, round(seconds, 3))
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} с"
+    return f"{seconds} с"
+
+def _single(field, template="{}"):
+    return lambda match: {field: template.format(*(_text(group) for group in match.groups()))}
+
+BOOT_SECTIONS = ("BOOTCONFIG", "KERNEL CMDLINE", "KERNEL LOG")
+
+# Реестр извлекателей; порядок реестра — порядок строк в отчёте внутри группы
+EXTRACTORS = [
+    Extractor("build", b"Build:", rb'Build:\s*([^\s]+)', _single("build"),
+              [("build", "Build")], "build", sections=(HEADER_SECTION,)),
+    Extractor("ram", b"androidboot.hardware.ddr",
+              rb'androidboot\.hardware\.ddr\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"\s*,\s*"([^"]+)"',
+              _single("ram", "{}, {}, {}"), [("ram", "RAM")], "ram", sections=BOOT_SECTIONS),
+    Extractor("rom", b"androidboot.hardware.ufs",
+              rb'androidboot\.hardware\.ufs\s*=\s*"([^"]+)"\s*,\s*"([^"]+)"',
+              _single("rom", "{}, {}"), [("rom", "ROM")], "rom", sections=BOOT_SECTIONS),
+    Extractor("healthd", b"healthd", rb'healthd:.*fc=(\d+).*cc=(\d+)', _convert_healthd,
+              [("capacity", "Остаточная емкость"), ("cycles", "Циклы заряда")], "battery",
+              sections=("KERNEL LOG",)),
+    Extractor("battery_drain", b"mDreamsBatteryLevelDrain", rb'mDreamsBatteryLevelDrain=(-?\d+)',
+              _convert_battery_drain, [("battery_health", None)], "battery", sections=("dreams",)),
+    Extractor("display_id", b"mPhysicalDisplayId", rb'mPhysicalDisplayId=(\d+)', _single("display_id"),
+              [("display_id", "ID")], "display", sections=("display",)),
+    Extractor("display_mode", b"mActiveSfDisplayMode",
+              rb'mActiveSfDisplayMode=(?=(?:.*?width=(\d+), height=(\d+))?)(?=(?:.*?xDpi=([\d.]+), yDpi=([\d.]+))?)',
+              _convert_display_mode, [("resolution", "Разрешение"), ("dpi", "DPI")], "display",
+              sections=("display",)),
+    Extractor("refresh_rates", b"mSupportedRefreshRates", rb'mSupportedRefreshRates=\[([\d\., ]+)\]',
+              _convert_refresh_rates, [("refresh_rates", "Частота обновления")], "display",
+              sections=("display",)),
+    Extractor("manufacturer", b"manufacturerPnpId", rb'manufacturerPnpId=(\w+)', _single("manufacturer"),
+              [("manufacturer", "Производитель")], "display", sections=("display",)),
+    Extractor("manufacture_date", b"ManufactureDate", rb'ManufactureDate\{week=(\d+), year=(\d+)\}',
+              lambda match: {"manufacture_date": f"{_text(match.group(2))} г."},
+              [("manufacture_date", "Дата производства")], "display", sections=("display",)),
+    Extractor("brightness", b"mNits", rb'mNits=\[([\d\., ]+)\]', _convert_brightness,
+              [("brightness", "Максимальная яркость")], "display", sections=("display",)),
+    Extractor("accounts", b"Account {", rb'Account\s*\{name=([^,]+?),\s*type=([^\}]+?)\}', _convert_account,
+              [("accounts", None)], "accounts", sections=("account",), multi=True,
+              key=lambda account: f"{account[0].lower()}|{account[1].lower()}",
+              render=lambda account: f"{account[0]} ({account[1]})"),
+    Extractor("top_apps", (b"Uid ", b"UID "), rb'U(?:id|ID) (u\d+[a-z]\d+|\d+): ([\d.]+)', _convert_power_use,
+              [("top_apps", "Приложения")], "battery_usage", sections=("batterystats",), top=TOP_K,
+              render=lambda app: f"{app[0]}: {app[1]:.1f} mAh"),
+    Extractor("top_wakelocks", b"Wake lock ",
+              rb'Wake lock (u\d+[a-z]\d+|\d+) (.+?): ((?:\d+(?:ms|d|h|m|s) )*\d+(?:ms|d|h|m|s))\b',
+              _convert_wakelock, [("top_wakelocks", "Wakelock")], "battery_usage", sections=("batterystats",),
+              top=TOP_K, render=lambda wakelock: f"{wakelock[0]} ({wakelock[1]}): {_format_duration(wakelock[2])}"),
+]
+
+# Группы отчёта: (группа, заголовок, вид). "line" — одно значение в строке заголовка,
+# "list" — пункты с подписями, "items" — список значений открытого поля,
+# "top" — списки лидеров, каждый под своей подписью
+RESULT_GROUPS = [
+    ("build", "📱 Build", "line"),
+    ("ram", "💾 RAM", "line"),
+    ("rom", "💽 ROM", "line"),
+    ("battery", "🔋 Батарея", "list"),
+    ("display", "🖥️ Дисплей", "list"),
+    ("accounts", "👥 Аккаунты", "items"),
+    ("battery_usage", "🔥 Расход батареи", "top"),
+]
+
+NOT_CHECKED = "Не проверено (превышен лимит)"
+IN_PROGRESS = "⏳"
+
+class BudgetExceeded(Exception):
+    pass
+
+# Лимит времени и объёма просмотренных байт на один разбор
+class ParseBudget:
+    def __init__(self, seconds=None, max_bytes=None):
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.max_bytes = max_bytes
+        self.scanned = 0
+
+    def check(self):
+        if self.max_bytes is not None and self.scanned >= self.max_bytes:
+            raise BudgetExceeded("bytes")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BudgetExceeded("time")
+
+def _new_result():
+    data = {}
+    for extractor in EXTRACTORS:
+        for field, _ in extractor.fields:
+            data[field] = [] if extractor.multi else NOT_FOUND
+    # True — разбор остановлен по лимиту, часть лога не просмотрена
+    data["partial"] = False
     return data
 
-# Форматирование результатов
-def format_results(data):
-    accounts = "\n".join([f"• {name} ({type})" for name, type in data["accounts"]]) or "Не найдено"
-    battery_info = f"• Остаточная емкость: {data['capacity']}"
-    if data["battery_health"] != "Не найдено":
-        battery_info += f" ({data['battery_health']})"
-    battery_info += "\n"
-    
-    return (
-        "🔍 Результаты анализа лога:\n\n"
-        f"📱 Build: {data['build']}\n\n"
-        f"💾 RAM: {data['ram']}\n\n"
-        f"💽 ROM: {data['rom']}\n\n"
-        "🔋 Батарея:\n"
-        f"{battery_info}"
-        f"• Циклы заряда: {data['cycles']}\n\n"
-        #📱💾💽
-        "🖥️ Дисплей:\n"
-        f"• ID: {data['display_id']}\n"
-        f"• Разрешение: {data['resolution']}\n"
-        f"• DPI: {data['dpi']}\n"
-        f"• Частота обновления: {data['refresh_rates']}\n"
-        f"• Производитель: {data['manufacturer']}\n"
-        f"• Дата производства: {data['manufacture_date']}\n"
-        f"• Максимальная яркость: {data['brightness']}\n\n"
-        f"👥 Аккаунты:\n{accounts}"
-    )
+def _new_state(budget=None, on_progress=None):
+    return {
+        # Множества для удаления дубликатов в списках
+        "seen": {},
+        # Кучи TopK списков лидеров
+        "top": {},
+        # Секция открытых списков, внутри которой сейчас идёт разбор
+        "open_section": None,
+        # Секции списков, которые уже закончились
+        "closed": set(),
+        "budget": budget,
+        # on_progress(группа, data) вызывается, когда поле группы найдено или список закрыт
+        "on_progress": on_progress,
+    }
+
+def _is_done(extractor, data, state):
+    if extractor.multi:
+        return extractor.sections[0] in state["closed"]
+    return data[extractor.field] != NOT_FOUND
+
+def _track_service_section(line, state, extractors):
+    # Секция открытого списка закрывается, когда начинается следующая секция dumpsys
+    if state["open_section"] is not None:
+        state["closed"].add(state["open_section"])
+        state["open_section"] = None
+    header = line.lstrip()
+    for extractor in extractors:
+        if extractor.multi and header.startswith(extractor.section_header):
+            state["open_section"] = extractor.sections[0]
+
+# Компиляция одного общего шаблона по ключевым словам ещё не найденных полей.
+# Ключевые слова списков лидеров включаются только внутри их секции
+def _compile_dispatch(active, state):
+    handlers = {}
+    for extractor in active:
+        if extractor.top is None or state["open_section"] == extractor.sections[0]:
+            for keyword in extractor.keywords:
+                handlers[keyword] = extractor
+    if any(extractor.multi for extractor in active):
+        handlers[SERVICE_MARKER] = None
+    scanner = re.compile(b"|".join(re.escape(keyword) for keyword in handlers))
+    return scanner, handlers
+
+def _report_progress(group, data, state):
+    if state["on_progress"] is not None:
+        state["on_progress"](group, data)
+
+# Проход общим шаблоном по буферу buf[start:end] (bytes или mmap) без разбиения на строки:
+# строка выделяется только вокруг совпадения. Возвращает True, когда все поля найдены.
+def _scan_window(buf, start, end, data, state, extractors):
+    active = [e for e in extractors if not _is_done(e, data, state)]
+    if not active:
+        return True
+    scanner, handlers = _compile_dispatch(active, state)
+
+    # В одной строке может быть несколько полей (manufacturerPnpId и ManufactureDate)
+    match = scanner.search(buf, start, end)
+    while match:
+        line_start = buf.rfind(b"\n", start, match.start()) + 1 or start
+        line_end = buf.find(b"\n", match.end(), end)
+        if line_end == -1:
+            line_end = end
+        line = buf[line_start:line_end]
+
+        extractor = handlers[match.group(0)]
+        rescoped = False
+        if extractor is None:
+            opened = state["open_section"]
+            _track_service_section(line, state, extractors)
+            finished = bool(state["closed"])
+            rescoped = state["open_section"] != opened
+            if opened is not None:
+                for group in dict.fromkeys(e.group for e in extractors if e.multi and e.sections[0] == opened):
+                    _report_progress(group, data, state)
+        else:
+            extractor.extract(line, data, state)
+            finished = _is_done(extractor, data, state)
+            if finished and not extractor.multi:
+                _report_progress(extractor.group, data, state)
+
+        # Исключаем завершённые поля из общего шаблона
+        if finished or rescoped:
+            still_active = [e for e in active if not _is_done(e, data, state)]
+            # Все одиночные поля найдены, а секции списков закрыты — дальше не читаем
+            if not still_active:
+                return True
+            if rescoped or len(still_active) != len(active):
+                active = still_active
+                scanner, handlers = _compile_dispatch(active, state)
+        match = scanner.search(buf, match.end(), end)
+    return False
+
+# Проход по диапазону окнами по SCAN_CHUNK_SIZE, с проверкой лимита перед каждым окном
+def _scan(buf, start, end, data, state, extractors):
+    budget = state["budget"]
+    if budget is None:
+        return _scan_window(buf, start, end, data, state, extractors)
+
+    pos = start
+    while pos < end:
+        budget.check()
+        stop = min(end, pos + SCAN_CHUNK_SIZE)
+        if stop < end:
+            # Окно заканчивается на границе строки
+            cut = buf.rfind(b"\n", pos, stop)
+            if cut > pos:
+                stop = cut + 1
+        finished = _scan_window(buf, pos, stop, data, state, extractors)
+        budget.scanned += stop - pos
+        if finished:
+            return True
+        pos = stop
+    return False
+
+# Чтение потока блоками, обрезанными по концу последней целой строки
+def _iter_chunks(file):
+    tail = b""
+    while True:
+        block = file.read(SCAN_CHUNK_SIZE)
+        if not block:
+            if tail:
+                yield tail
+            return
+        block = tail + block
+        cut = block.rfind(b"\n") + 1
+        if cut:
+            yield block[:cut]
+        tail = block[cut:]
+
+# Функция для извлечения информации из лог-файла: поток (z.open, open(..., "rb"))
+# или любая последовательность строк bytes/str
+def parse_log_file(file, budget=None, on_progress=None):
+    data, state = _new_result(), _new_state(budget, on_progress)
+    if hasattr(file, "read"):
+        chunks = _iter_chunks(file)
+    else:
+        chunks = (line.encode('utf-8') if isinstance(line, str) else line for line in file)
+
+    try:
+        for chunk in chunks:
+            if _scan(chunk, 0, len(chunk), data, state, EXTRACTORS):
+                break
+    except BudgetExceeded:
+        data["partial"] = True
+    return data
+
+# Счётчики извлекателей текущего процесса: имя -> (срабатывания, секунды). Рабочие процессы пула
+# сбрасывают их перед каждой задачей и возвращают вместе с результатом
+def extractor_stats():
+    return {extractor.name: (extractor.hits, extractor.seconds) for extractor in EXTRACTORS}
+
+def reset_extractor_stats():
+    for extractor in EXTRACTORS:
+        extractor.hits = 0
+        extractor.seconds = 0.0
+
+# Заголовки секций bugreport: "DUMP OF SERVICE display:" и "------ KERNEL LOG (dmesg) ------".
+# Ведущий перевод строки даёт движку литеральный префикс — индекс строится в разы быстрее, чем с ^
+SECTION_HEADER = re.compile(
+    rb'\n(?:DUMP OF SERVICE (?:CRITICAL |HIGH |NORMAL )?([^\s:]+):|------ ([^\r\n]*?) ------)[ \t]*\r?$',
+    re.MULTILINE
+)
+
+# Индекс секций: имя -> список диапазонов байтов [начало, конец)
+def build_section_index(mm):
+    index = {}
+    name, start = HEADER_SECTION, 0
+    for match in SECTION_HEADER.finditer(mm):
+        index.setdefault(name, []).append((start, match.start() + 1))
+        if match.group(1) is not None:
+            name = match.group(1).decode('utf-8', errors='ignore')
+        else:
+            title = match.group(2).decode('utf-8', errors='ignore')
+            # Строки "------ 0.01s was the duration of '...' ------" только закрывают секцию
+            name = None if "was the duration of" in title else title.split(" (")[0]
+        start = match.start() + 1
+    index.setdefault(name, []).append((start, len(mm)))
+    index.pop(None, None)
+    return index
+
+# Диапазоны [начало, конец) файла размера size, не входящие ни в одну из секций sections
+def _unscanned_ranges(index, sections, size):
+    covered = sorted(r for section in sections for r in index.get(section, ()))
+    gaps, pos = [], 0
+    for start, end in covered:
+        if start > pos:
+            gaps.append((pos, start))
+        pos = max(pos, end)
+    if pos < size:
+        gaps.append((pos, size))
+    return gaps
+
+# Разбор по индексу: каждый извлекатель читает только свои секции
+def parse_sections(mm, index, budget=None, on_progress=None):
+    data, state = _new_result(), _new_state(budget, on_progress)
+
+    plan = {}
+    for extractor in EXTRACTORS:
+        for section in extractor.sections:
+            plan.setdefault(section, []).append(extractor)
+
+    try:
+        for section, extractors in plan.items():
+            for start, end in index.get(section, ()):
+                _scan(mm, start, end, data, state, extractors)
+        for extractor in EXTRACTORS:
+            if extractor.multi and extractor.sections[0] in index:
+                state["closed"].add(extractor.sections[0])
+                _report_progress(extractor.group, data, state)
+
+        # Извлекатели, ни одной секции которых нет в индексе (секция названа иначе или у поля её нет),
+        # ищут свои поля в ещё не прочитанной части файла. Поле, не найденное в своей секции, отсутствует
+        missing = [e for e in EXTRACTORS if not any(section in index for section in e.sections)]
+        if missing:
+            state["open_section"] = None
+            for start, end in _unscanned_ranges(index, plan, len(mm)):
+                if _scan(mm, start, end, data, state, missing):
+                    break
+    except BudgetExceeded:
+        data["partial"] = True
+    return data
+
+def _render_field(data, field, label, missing):
+    value = data[field]
+    line = f"• {label}: {missing if value == NOT_FOUND else value}"
+    # Состояние батареи дописывается к емкости, если оно найдено
+    if field == "capacity" and value != NOT_FOUND and data["battery_health"] != NOT_FOUND:
+        line += f" ({data['battery_health']})"
+    return line
+
+# Форматирование результатов по реестру извлекателей. in_progress — промежуточный результат
+# (ненайденное ещё ищется); для частичного результата ненайденное помечается как непроверенное
+def format_results(data, in_progress=False):
+    if in_progress:
+        title_line, missing = "⏳ Анализ лога, промежуточные результаты:", IN_PROGRESS
+    elif data.get("partial"):
+        title_line, missing = "🔍 Результаты анализа лога (неполные: превышен лимит обработки):", NOT_CHECKED
+    else:
+        title_line, missing = "🔍 Результаты анализа лога:", NOT_FOUND
+
+    blocks = []
+    for group, title, kind in RESULT_GROUPS:
+        extractors = [extractor for extractor in EXTRACTORS if extractor.group == group]
+        fields = [(field, label) for extractor in extractors for field, label in extractor.fields]
+        if kind == "line":
+            field, _ = fields[0]
+            value = data[field]
+            blocks.append(f"{title}: {missing if value == NOT_FOUND else value}")
+        elif kind == "list":
+            lines = [_render_field(data, field, label, missing) for field, label in fields if label]
+            blocks.append(f"{title}:\n" + "\n".join(lines))
+        elif kind == "items":
+            extractor = extractors[0]
+            items = "\n".join([f"• {extractor.render(item)}" for item in data[extractor.field]]) or missing
+            blocks.append(f"{title}:\n{items}")
+        else:
+            lines = []
+            for extractor in extractors:
+                if data[extractor.field]:
+                    lines.append(f"{extractor.fields[0][1]}:")
+                    lines += [f"• {extractor.render(item)}" for item in data[extractor.field]]
+            blocks.append(f"{title}:\n" + ("\n".join(lines) or missing))
+
+    return f"{title_line}\n\n" + "\n\n".join(blocks)
 
 # Обработчик команды /start
 async def start(update: Update, context):
@@ -203,7 +631,8 @@ async def start(update: Update, context):
         "- Характеристиках RAM и ROM\n"
         "- Параметрах дисплея (разрешение, DPI, яркость)\n"
         "- Привязанных аккаунтах\n\n"
-        "Просто отправь мне ZIP-файл с логом!"
+        "Просто отправь мне ZIP-файл с логом!\n"
+        "История батареи по твоим отчётам: /history"
     )
     
     await update.message.reply_text(
@@ -249,6 +678,649 @@ async def back_to_main(update: Update, context):
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📖 Показать инструкцию", callback_data='instruction')]])
     )
 
+class LogNotFoundError(Exception):
+    pass
+
+# Архив отклонён до распаковки (похож на zip-бомбу или слишком велик)
+class ArchiveRejectedError(Exception):
+    pass
+
+def _is_log_name(name):
+    return "bugreport" in name and name.endswith('.txt')
+
+def _check_member(info):
+    if info.file_size > MAX_LOG_SIZE:
+        raise ArchiveRejectedError(f"{info.filename}: заявлено {info.file_size // MB} МБ, лимит {MAX_LOG_SIZE // MB} МБ")
+    if info.file_size and info.file_size > info.compress_size * MAX_COMPRESSION_RATIO:
+        raise ArchiveRejectedError(f"{info.filename}: степень сжатия больше {MAX_COMPRESSION_RATIO}")
+
+# Файл, указанный в main_entry.txt (так его пишет dumpstate)
+def _main_entry(z, by_name):
+    info = by_name.get(MAIN_ENTRY)
+    if info is None or info.file_size > 4096:
+        return None
+    return by_name.get(z.read(info).decode('utf-8', errors='ignore').strip())
+
+# Выбор лога по центральному каталогу, без распаковки кандидатов. Возвращает путь из ZipInfo:
+# (лог,) или (вложенный архив, ..., лог). Файл из main_entry.txt берётся в первую очередь,
+# иначе — самый большой bugreport*.txt, в том числе во вложенных ZIP
+def select_log_member(z, depth=0):
+    infos = z.infolist()
+    if len(infos) > MAX_ARCHIVE_MEMBERS:
+        raise ArchiveRejectedError(f"в архиве больше {MAX_ARCHIVE_MEMBERS} файлов")
+    by_name = {info.filename: info for info in infos}
+
+    main_entry = _main_entry(z, by_name)
+    if main_entry is not None and not main_entry.filename.endswith('.zip'):
+        _check_member(main_entry)
+        return (main_entry,)
+
+    candidates = [(info,) for info in infos if _is_log_name(info.filename)]
+    nested = [main_entry] if main_entry is not None else [info for info in infos if info.filename.endswith('.zip')]
+    if depth < MAX_NESTING:
+        for info in nested:
+            _check_member(info)
+            try:
+                with z.open(info) as src, zipfile.ZipFile(src) as inner:
+                    candidates.append((info,) + select_log_member(inner, depth + 1))
+            except (LogNotFoundError, zipfile.BadZipFile):
+                continue
+    if not candidates:
+        raise LogNotFoundError("bugreport*.txt")
+
+    path = max(candidates, key=lambda candidate: candidate[-1].file_size)
+    _check_member(path[-1])
+    return path
+
+# Поток выбранного лога; вложенные архивы читаются потоком из внешнего, без распаковки на диск.
+# Распакованный поток не длиннее заявленного file_size, поэтому проверок по центральному каталогу достаточно
+@contextmanager
+def open_log_member(z):
+    path = select_log_member(z)
+    with ExitStack() as stack:
+        archive = z
+        for info in path[:-1]:
+            archive = stack.enter_context(zipfile.ZipFile(stack.enter_context(archive.open(info))))
+        yield stack.enter_context(archive.open(path[-1]))
+
+def parse_mapped_file(path, budget=None, on_progress=None):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return parse_log_file([])
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return parse_sections(mm, build_section_index(mm), budget, on_progress)
+
+# Копирование с ограничением объёма и времени (deadline по time.monotonic);
+# True — источник прочитан не полностью
+def _copy_limited(src, dst, limit, deadline=None):
+    copied = 0
+    while limit is None or copied < limit:
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+        size = COPY_CHUNK_SIZE if limit is None else min(COPY_CHUNK_SIZE, limit - copied)
+        chunk = src.read(size)
+        if not chunk:
+            return False
+        dst.write(chunk)
+        copied += len(chunk)
+    return bool(src.read(1))
+
+# Этап в процессе бота: гистограмма длительности и, если передан memory, снимок памяти
+@contextmanager
+def _stage(name, memory=None):
+    with bot_metrics.timed(bot_metrics.STAGE_SECONDS, bot="phonestat", stage=name):
+        with _measured(name, {}, memory):
+            yield
+
+def _event(name):
+    bot_metrics.inc(bot_metrics.EVENTS, bot="phonestat", event=name)
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Максимальный RSS процесса; None — модуля resource нет (Windows).
+# ru_maxrss в macOS — в байтах, в Linux и других Unix — в килобайтах
+def _rss_peak_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Снимок памяти после этапа: пик tracemalloc с начала этапа, текущий RSS и максимальный RSS процесса
+def _memory_snapshot():
+    traced_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    return {
+        "traced_peak": traced_peak,
+        "rss": _rss_bytes(),
+        "rss_peak": _rss_peak_bytes(),
+    }
+
+# Длительность этапа в timings; если передан memory — ещё и снимок памяти (пик tracemalloc
+# сбрасывается в начале этапа). В процессе бота задачи идут параллельно, и пик этапа включает
+# память соседних задач
+@contextmanager
+def _measured(name, timings, memory=None):
+    if memory is not None and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+        if memory is not None:
+            memory[name] = _memory_snapshot()
+
+def _format_mb(value):
+    return "-" if value is None else f"{value / MB:.1f}"
+
+def format_memory_report(memory):
+    return ", ".join(
+        f"{stage}: traced_peak={_format_mb(m['traced_peak'])}MB rss={_format_mb(m['rss'])}MB "
+        f"rss_peak={_format_mb(m['rss_peak'])}MB"
+        for stage, m in memory.items()
+    )
+
+# Распаковка выбранного лога во временный файл и разбор через mmap.
+# В timings записывается длительность этапов (рабочий процесс возвращает их вместе с результатом),
+# в memory, если он передан, — память по этапам.
+# При лимитах распаковывается не больше budget.max_bytes байт лога и не дольше срока budget.deadline
+def analyze_zip_path(zip_path, work_dir, timings=None, budget=None, on_progress=None, memory=None):
+    timings = {} if timings is None else timings
+    log_path = os.path.join(work_dir, "bugreport.txt")
+
+    with _measured("zip_open", timings, memory):
+        z = zipfile.ZipFile(zip_path)
+    with z:
+        with _measured("unzip", timings, memory):
+            with open_log_member(z) as src, open(log_path, "wb") as dst:
+                if budget is None:
+                    truncated = _copy_limited(src, dst, None)
+                else:
+                    truncated = _copy_limited(src, dst, budget.max_bytes, budget.deadline)
+
+    with _measured("parse", timings, memory):
+        data = parse_mapped_file(log_path, budget=budget, on_progress=on_progress)
+    # Конец лога не распакован: могли остаться не найдены поля и не дочитаны списки
+    if truncated:
+        data["partial"] = True
+    return data
+
+def analyze_zip_bytes(buf, timings=None, budget=None, on_progress=None, memory=None):
+    timings = {} if timings is None else timings
+    with _measured("zip_open", timings, memory):
+        z = zipfile.ZipFile(io.BytesIO(buf))
+    with z:
+        # Распаковка идёт потоком вместе с разбором
+        with _measured("unzip_parse", timings, memory):
+            with open_log_member(z) as log_file:
+                data = parse_log_file(log_file, budget, on_progress)
+    return data
+
+# Промежуточные результаты из рабочего процесса уходят в очередь менеджера (снимок data)
+def _progress_sender(progress):
+    if progress is None:
+        return None
+    return lambda group, data: progress.put((group, dict(data)))
+
+# Задачи для пула процессов: результат вместе с длительностью этапов, счётчиками извлекателей
+# и, при profile, памятью по этапам.
+# Лимиты передаются явно: рабочие процессы не видят изменений настроек после своего запуска
+def _profiled_job(analyze, profile, *args, **kwargs):
+    timings = {}
+    memory = {} if profile else None
+    reset_extractor_stats()
+    if profile:
+        tracemalloc.start()
+    try:
+        data = analyze(*args, timings=timings, memory=memory, **kwargs)
+    finally:
+        if profile:
+            tracemalloc.stop()
+    return data, timings, extractor_stats(), memory
+
+def _zip_path_job(zip_path, work_dir, progress=None, seconds=None, max_bytes=None, profile=False):
+    budget = ParseBudget(seconds, max_bytes)
+    return _profiled_job(analyze_zip_path, profile, zip_path, work_dir,
+                         budget=budget, on_progress=_progress_sender(progress))
+
+def _zip_bytes_job(buf, progress=None, seconds=None, max_bytes=None, profile=False):
+    budget = ParseBudget(seconds, max_bytes)
+    return _profiled_job(analyze_zip_bytes, profile, buf, budget=budget, on_progress=_progress_sender(progress))
+
+# Очередь задач разбора поверх пула процессов: общий лимит, лимит на пользователя
+# и позиция в очереди, пока все процессы заняты
+class ParseQueue:
+    def __init__(self, workers=PARSE_WORKERS, max_jobs=MAX_QUEUED_JOBS, max_per_user=MAX_JOBS_PER_USER):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(workers)
+        self.max_jobs = max_jobs
+        self.max_per_user = max_per_user
+        self.jobs = 0
+        self.user_jobs = {}
+        self.waiting = deque()
+        # Процесс менеджера для очередей промежуточных результатов запускается сразу, а не в обработчике
+        self.manager = multiprocessing.Manager()
+
+    # Резервирование места под задачу; возвращает текст отказа или None
+    def reserve(self, user_id):
+        if self.user_jobs.get(user_id, 0) >= self.max_per_user:
+            return "⏳ Ваш предыдущий файл ещё обрабатывается, дождитесь результата."
+        if self.jobs >= self.max_jobs:
+            return "⏳ Сейчас слишком много файлов в обработке, попробуйте позже."
+        self.jobs += 1
+        self.user_jobs[user_id] = self.user_jobs.get(user_id, 0) + 1
+        return None
+
+    def release(self, user_id):
+        self.jobs -= 1
+        self.user_jobs[user_id] -= 1
+        if not self.user_jobs[user_id]:
+            del self.user_jobs[user_id]
+
+    async def run(self, func, *args, on_queued=None):
+        queued_at = time.perf_counter()
+        if self.slots.locked():
+            token = object()
+            self.waiting.append(token)
+            try:
+                if on_queued:
+                    await on_queued(len(self.waiting))
+                await self.slots.acquire()
+            finally:
+                self.waiting.remove(token)
+        else:
+            await self.slots.acquire()
+        # Задержка очереди: от постановки задачи до свободного процесса
+        bot_metrics.observe(bot_metrics.STAGE_SECONDS, time.perf_counter() - queued_at, bot="phonestat", stage="queue_wait")
+
+        try:
+            loop = asyncio.get_running_loop()
+            with _stage("pool"):
+                return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.slots.release()
+
+    # Очередь для промежуточных результатов, доступная из рабочих процессов. Обращения к ней —
+    # запросы к процессу менеджера, поэтому из цикла событий они выполняются в отдельном потоке
+    def progress_channel(self):
+        return self.manager.Queue()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
+
+parse_queue = None
+
+def get_parse_queue():
+    global parse_queue
+    if parse_queue is None:
+        parse_queue = ParseQueue()
+    return parse_queue
+
+# LRU-кеш результатов в памяти с ограничением размера и TTL, плюс необязательный
+# слой на диске (по JSON-файлу на ключ), переживающий перезапуск бота. Просроченный файл удаляется
+# при чтении, а размер каталога ограничен max_bytes
+class ResultCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, cache_dir=CACHE_DIR,
+                 max_bytes=CACHE_DIR_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # ключ -> (время создания, результат)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def _remember(self, key, created, data):
+        self.entries[key] = (created, data)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                return entry[1]
+            del self.entries[key]
+
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            created, data = stored["created"], stored["data"]
+            # Набор полей сверяется с текущим: запись другой версии бота не подходит к выводу
+            expired = stored["key"] != key or now - created >= self.ttl or set(data) != set(_new_result())
+            if not expired:
+                data["accounts"] = [tuple(account) for account in data["accounts"]]
+        except OSError:
+            return None
+        # Повреждённый файл или файл не того формата считается просроченным
+        except (ValueError, KeyError, TypeError):
+            expired = True
+        if expired:
+            self._remove(path)
+            return None
+
+        self._remember(key, created, data)
+        return data
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # Удаление самых старых файлов, пока каталог не уложится в max_bytes
+    def _trim_disk(self):
+        files = []
+        total = 0
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+        except OSError:
+            return
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            self._remove(path)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def put(self, key, data):
+        created = time.time()
+        self._remember(key, created, data)
+        if self.cache_dir is None:
+            return
+
+        # Атомарная запись: временный файл + переименование
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(key)
+            with open(path + ".tmp", "w") as f:
+                json.dump({"key": key, "created": created, "data": data}, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            return
+        if self.max_bytes is not None:
+            self._trim_disk()
+
+result_cache = ResultCache()
+
+# Числа из отформатированных значений: "4500mAh" -> 4500, "93%" -> 93
+def _number(value):
+    match = re.match(r'-?\d+', value or "")
+    return int(match.group()) if match else None
+
+# История анализов: устройство определяется сборкой и ID дисплея. Хранятся готовые результаты
+# разбора, так что тренды и сравнения не требуют повторного разбора архивов
+class HistoryStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS reports (
+                id INTEGER PRIMARY KEY,
+                device_key TEXT NOT NULL,
+                report_key TEXT NOT NULL,
+                user_id INTEGER,
+                created REAL NOT NULL,
+                build TEXT,
+                display_id TEXT,
+                capacity_mah INTEGER,
+                cycles INTEGER,
+                health_pct INTEGER,
+                data TEXT NOT NULL,
+                UNIQUE (device_key, report_key)
+            );
+            CREATE INDEX IF NOT EXISTS reports_device_created ON reports (device_key, created);
+            CREATE INDEX IF NOT EXISTS reports_user_created ON reports (user_id, created);
+            CREATE INDEX IF NOT EXISTS reports_user_device_created ON reports (user_id, device_key, created);
+            """
+        )
+        # Однократно: записи, сохранённые вместе со списками (в том числе адресами аккаунтов)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            with self.db:
+                self.db.execute("UPDATE reports SET data = json_remove(data, '$.accounts', '$.top_apps', '$.top_wakelocks')")
+                self.db.execute("PRAGMA user_version = 1")
+
+    @staticmethod
+    def device_key(data):
+        if data["build"] == NOT_FOUND and data["display_id"] == NOT_FOUND:
+            return None
+        return f"{data['build']}|{data['display_id']}"
+
+    # Повторная отправка того же отчёта (тот же report_key) не создаёт новую запись. Списки
+    # (аккаунты, топы приложений) не сохраняются: для тренда и отличий нужны только одиночные поля
+    def add(self, data, report_key, user_id=None, created=None):
+        device_key = self.device_key(data)
+        if device_key is None or data.get("partial"):
+            return False
+        multi_fields = {extractor.field for extractor in EXTRACTORS if extractor.multi}
+        stored = {field: value for field, value in data.items() if field not in multi_fields}
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO reports (device_key, report_key, user_id, created, build, display_id, "
+                "capacity_mah, cycles, health_pct, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    device_key, report_key, user_id, created or time.time(), data["build"], data["display_id"],
+                    _number(data["capacity"]), _number(data["cycles"]), _number(data["battery_health"]),
+                    json.dumps(stored, ensure_ascii=False),
+                )
+            )
+        return cursor.rowcount > 0
+
+    # Устройства пользователя, начиная с последнего проанализированного
+    def user_devices(self, user_id):
+        return self.db.execute(
+            "SELECT device_key, MAX(created) AS last_created, COUNT(*) AS reports "
+            "FROM reports WHERE user_id = ? GROUP BY device_key ORDER BY last_created DESC",
+            (user_id,)
+        ).fetchall()
+
+    # Последние отчёты устройства, от новых к старым. device_key одинаков у всех телефонов одной
+    # модели с одной прошивкой, поэтому боту нужен user_id: иначе в истории окажутся чужие отчёты
+    def trend(self, device_key, limit=HISTORY_LIMIT, user_id=None):
+        if user_id is None:
+            return self.db.execute(
+                "SELECT * FROM reports WHERE device_key = ? ORDER BY created DESC LIMIT ?",
+                (device_key, limit)
+            ).fetchall()
+        return self.db.execute(
+            "SELECT * FROM reports WHERE device_key = ? AND user_id = ? ORDER BY created DESC LIMIT ?",
+            (device_key, user_id, limit)
+        ).fetchall()
+
+    def close(self):
+        self.db.close()
+
+history_store = None
+
+def get_history_store():
+    global history_store
+    if history_store is None and HISTORY_DB:
+        history_store = HistoryStore(HISTORY_DB)
+    return history_store
+
+def _with_unit(value, unit=""):
+    return f"{value}{unit}" if value is not None else NOT_FOUND
+
+def _delta(new, old, unit=""):
+    if new is None or old is None or new == old:
+        return ""
+    return f" ({new - old:+d}{unit})"
+
+# Текст тренда и отличий последнего отчёта от предыдущего
+def format_history(rows):
+    latest = rows[0]
+    lines = [
+        "📈 История устройства:",
+        f"Build: {latest['build']}, дисплей: {latest['display_id']}",
+        "",
+    ]
+    for row in rows:
+        date = datetime.fromtimestamp(row["created"]).strftime("%d.%m.%Y %H:%M")
+        lines.append(
+            f"• {date}: {_with_unit(row['capacity_mah'], 'mAh')}, циклов: {_with_unit(row['cycles'])}, "
+            f"состояние: {_with_unit(row['health_pct'], '%')}"
+        )
+
+    if len(rows) > 1:
+        previous = rows[1]
+        lines += [
+            "",
+            "🔄 Изменения с прошлого отчёта:",
+            f"• Емкость: {_with_unit(latest['capacity_mah'], 'mAh')}"
+            f"{_delta(latest['capacity_mah'], previous['capacity_mah'], 'mAh')}",
+            f"• Циклы: {_with_unit(latest['cycles'])}{_delta(latest['cycles'], previous['cycles'])}",
+            f"• Состояние: {_with_unit(latest['health_pct'], '%')}"
+            f"{_delta(latest['health_pct'], previous['health_pct'], '%')}",
+        ]
+        new_data, old_data = json.loads(latest["data"]), json.loads(previous["data"])
+        for extractor in EXTRACTORS:
+            for field, label in extractor.fields:
+                if (
+                    label and not extractor.multi and extractor.group != "battery"
+                    and new_data.get(field) != old_data.get(field)
+                ):
+                    lines.append(f"• {label}: {old_data.get(field)} → {new_data.get(field)}")
+    return "\n".join(lines)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Правка сообщения; "message is not modified" и подобные ошибки не мешают разбору
+async def _edit(placeholder, text):
+    try:
+        await placeholder.edit_text(text)
+        return True
+    except TelegramError:
+        return False
+
+# Последний из накопившихся промежуточных результатов; None — новых нет
+def _drain_progress(progress):
+    latest = None
+    while True:
+        try:
+            _, latest = progress.get_nowait()
+        except queue.Empty:
+            return latest
+
+# Промежуточные результаты из рабочего процесса: правка заглушки не чаще EDIT_INTERVAL.
+# Очередь опрашивается в отдельном потоке: каждое обращение к ней — запрос к процессу менеджера
+async def relay_progress(progress, placeholder):
+    latest, last_text, last_edit = None, None, 0.0
+    while True:
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+        latest = await asyncio.to_thread(_drain_progress, progress) or latest
+        if latest is None or time.monotonic() - last_edit < EDIT_INTERVAL:
+            continue
+        text = format_results(latest, in_progress=True)
+        if text != last_text:
+            await _edit(placeholder, text)
+            last_text, last_edit = text, time.monotonic()
+
+async def _run_job(jobs, key, placeholder, func, *args, on_queued=None, memory=None):
+    data = result_cache.get(key)
+    if data is not None:
+        _event("cache_hit_content")
+        return data
+
+    progress = await asyncio.to_thread(jobs.progress_channel)
+    relay = asyncio.create_task(relay_progress(progress, placeholder))
+    try:
+        data, timings, extractors, job_memory = await jobs.run(
+            func, *args, progress, PARSE_TIME_BUDGET, PARSE_BYTE_BUDGET, memory is not None, on_queued=on_queued
+        )
+    finally:
+        relay.cancel()
+    for stage, seconds in timings.items():
+        bot_metrics.observe(bot_metrics.STAGE_SECONDS, seconds, bot="phonestat", stage=stage)
+    for name, (hits, seconds) in extractors.items():
+        if hits:
+            bot_metrics.inc(EXTRACTOR_HITS, hits, bot="phonestat", extractor=name)
+            bot_metrics.observe(bot_metrics.STAGE_SECONDS, seconds, bot="phonestat", stage=f"extract_{name}")
+    if memory is not None:
+        # Этапы рабочего процесса: RSS относится к нему, а не к процессу бота
+        memory.update(job_memory)
+    if data["partial"]:
+        _event("job_partial")
+    else:
+        result_cache.put(key, data)
+    return data
+
+async def analyze_on_disk(file, jobs, placeholder, on_queued=None, memory=None):
+    # Временный каталог удаляется в любом случае, в том числе при ошибке разбора
+    with tempfile.TemporaryDirectory(prefix="phonestat_", dir=TEMP_DIR) as work_dir:
+        zip_path = os.path.join(work_dir, "report.zip")
+        with _stage("download", memory):
+            await file.download_to_drive(zip_path)
+
+        # Тот же архив мог прийти под другим file_unique_id (например, пересланный)
+        with _stage("hash", memory):
+            key = "sha256:" + await asyncio.to_thread(file_sha256, zip_path)
+        return await _run_job(
+            jobs, key, placeholder, _zip_path_job, zip_path, work_dir, on_queued=on_queued, memory=memory
+        )
+
+async def analyze_in_memory(file, jobs, placeholder, on_queued=None, memory=None):
+    file_stream = io.BytesIO()
+    with _stage("download", memory):
+        await file.download_to_memory(file_stream)
+    buf = file_stream.getvalue()
+
+    with _stage("hash", memory):
+        key = "sha256:" + hashlib.sha256(buf).hexdigest()
+    return await _run_job(jobs, key, placeholder, _zip_bytes_job, buf, on_queued=on_queued, memory=memory)
+
+async def _reply_results(message, data, placeholder=None, memory=None):
+    with _stage("format", memory):
+        text = format_results(data)
+    with _stage("reply"):
+        # Итог заменяет заглушку; если её не удалось изменить — отдельным сообщением
+        if placeholder is None or not await _edit(placeholder, text):
+            await message.reply_text(text)
+
+def _save_history(data, report_key, user_id):
+    store = get_history_store()
+    if store is not None:
+        with _stage("history_save"):
+            # Ключ с пользователем: тот же файл от другого пользователя попадает в его историю
+            store.add(data, f"{user_id}:{report_key}", user_id)
+
+# Обработчик команды /history: тренд батареи последнего устройства пользователя
+async def show_history(update: Update, context):
+    store = get_history_store()
+    devices = store.user_devices(update.effective_user.id) if store else []
+    if not devices:
+        await update.message.reply_text("📈 История пуста: пришлите ZIP-файл с логом, чтобы начать её вести.")
+        return
+
+    rows = store.trend(devices[0]["device_key"], user_id=update.effective_user.id)
+    await update.message.reply_text(format_history(rows))
+
 # Обработчик ZIP-файлов
 async def handle_zip(update: Update, context):
     message = update.message
@@ -257,50 +1329,261 @@ async def handle_zip(update: Update, context):
     if not document.file_name.endswith('.zip'):
         await message.reply_text("❌ Пожалуйста, отправьте ZIP-файл.")
         return
-        
-    # Скачивание файла
-    file = await context.bot.get_file(document)
-    file_stream = io.BytesIO()
-    await file.download_to_memory(file_stream)
-    file_stream.seek(0)
-    
+
+    # Повторно присланный файл: ответ из кеша без скачивания и разбора
+    cache_key = "uid:" + document.file_unique_id
+    data = result_cache.get(cache_key)
+    if data is not None:
+        _event("cache_hit_file_id")
+        try:
+            await _reply_results(message, data)
+            _save_history(data, cache_key, update.effective_user.id)
+        except Exception as e:
+            _event("job_failed")
+            await message.reply_text(f"⛔ Ошибка обработки файла: {str(e)}")
+        return
+
+    user_id = update.effective_user.id
+    jobs = get_parse_queue()
+    refusal = jobs.reserve(user_id)
+    if refusal:
+        _event("job_refused")
+        await message.reply_text(refusal)
+        return
+
+    # Заглушка сразу; дальше она правится по мере появления результатов.
+    # Место в очереди освобождается и тогда, когда заглушку отправить не удалось
+    try:
+        placeholder = await message.reply_text("⏳ Файл получен, начинаю анализ...")
+    except BaseException:
+        jobs.release(user_id)
+        raise
+
+    async def notify_queued(position):
+        await _edit(placeholder, f"⏳ Файл в очереди на обработку, позиция {position}.")
+
+    memory = {} if MEMORY_PROFILE else None
+    try:
+        # Скачивание файла; распаковка и разбор выполняются в пуле процессов
+        with _stage("handle_zip"):
+            file = await context.bot.get_file(document)
+            if DISK_MODE:
+                data = await analyze_on_disk(file, jobs, placeholder, notify_queued, memory)
+            else:
+                data = await analyze_in_memory(file, jobs, placeholder, notify_queued, memory)
+            if not data["partial"]:
+                result_cache.put(cache_key, data)
+            await _reply_results(message, data, placeholder, memory)
+            _save_history(data, cache_key, user_id)
+        _event("job_done")
+        if memory:
+            logger.info(f"Память задачи {document.file_name}: {format_memory_report(memory)}")
+
+    except LogNotFoundError:
+        _event("job_log_not_found")
+        await _edit(placeholder, "❌ Файл лога bugreport*.txt не найден в архиве.")
+    except ArchiveRejectedError as e:
+        _event("job_rejected")
+        await _edit(placeholder, f"❌ Архив отклонён: {e}")
+    except Exception as e:
+        _event("job_failed")
+        await _edit(placeholder, f"⛔ Ошибка обработки файла: {str(e)}")
+    finally:
+        jobs.release(user_id)
+
+# Пул процессов и менеджер очередей запускаются вместе с ботом, а не при первом файле
+async def start_parse_queue(application):
+    await asyncio.to_thread(get_parse_queue)
+
+async def shutdown_parse_queue(application):
+    if parse_queue is not None:
+        parse_queue.shutdown()
+
+# ====================== Пакетный режим (CLI) ======================
+
+RESULT_FIELDS = list(_new_result())
+
+# Разбор одного архива в рабочем процессе; ошибки возвращаются в результате
+def analyze_archive(path):
     try:
-        # Обработка ZIP-архива
-        with zipfile.ZipFile(file_stream) as z:
-            # Ищем лог-файл в корне и поддиректориях
-            log_files = []
-            for file_info in z.infolist():
-                if "bugreport" in file_info.filename and file_info.filename.endswith('.txt'):
-                    log_files.append(file_info.filename)
-            
-            if not log_files:
-                await message.reply_text("❌ Файл лога bugreport*.txt не найден в архиве.")
-                return
-                
-            # Берём первый найденный лог-файл
-            with z.open(log_files[0]) as log_file:
-                data = parse_log_file(log_file)
-                result = format_results(data)
-                await message.reply_text(result)
-                
+        with tempfile.TemporaryDirectory(prefix="phonestat_", dir=TEMP_DIR) as work_dir:
+            return {"file": path, "error": "", **analyze_zip_path(path, work_dir)}
+    except LogNotFoundError:
+        return {"file": path, "error": "bugreport*.txt не найден в архиве"}
+    except ArchiveRejectedError as e:
+        return {"file": path, "error": f"архив отклонён: {e}"}
     except Exception as e:
-        await message.reply_text(f"⛔ Ошибка обработки файла: {str(e)}")
+        return {"file": path, "error": str(e)}
 
-# Основная функция
-def main():
-    # Загрузка токена из файла
-    with open('token.txt') as f:
-        token = f.read().strip()
-    
-    app = Application.builder().token(token).build()
+def collect_archives(source):
+    if os.path.isdir(source):
+        pattern = os.path.join(source, "**", "*.zip")
+    else:
+        pattern = source
+    return sorted(glob.glob(pattern, recursive=True))
+
+# Уже обработанные файлы из существующего вывода (для продолжения после перезапуска)
+def load_processed(output, fmt):
+    processed = set()
+    if not output or not os.path.exists(output):
+        return processed
+    with open(output, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            for row in csv.DictReader(f):
+                processed.add(row["file"])
+        else:
+            for line in f:
+                try:
+                    processed.add(json.loads(line)["file"])
+                except (ValueError, KeyError):
+                    # Последняя строка могла оборваться при аварийной остановке
+                    continue
+    return processed
+
+class ResultWriter:
+    def __init__(self, out, fmt, write_header):
+        self.out = out
+        self.fmt = fmt
+        if fmt == "csv":
+            self.writer = csv.DictWriter(out, fieldnames=["file", "error"] + RESULT_FIELDS)
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, result):
+        if self.fmt == "csv":
+            row = dict(result)
+            for extractor in EXTRACTORS:
+                if extractor.multi:
+                    row[extractor.field] = "; ".join(extractor.render(item) for item in result.get(extractor.field, []))
+            self.writer.writerow(row)
+        else:
+            self.out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        # Каждая строка сразу на диске: при перезапуске с --resume она не будет пересчитана
+        self.out.flush()
+
+def run_batch(args):
+    archives = collect_archives(args.source)
+    processed = load_processed(args.output, args.format) if args.resume else set()
+    pending = [path for path in archives if path not in processed]
+    print(f"Найдено архивов: {len(archives)}, к обработке: {len(pending)}", file=sys.stderr)
+
+    if args.output:
+        append = args.resume and os.path.exists(args.output) and os.path.getsize(args.output) > 0
+        out = open(args.output, "a" if append else "w", newline="", encoding="utf-8")
+    else:
+        append = False
+        out = sys.stdout
+
+    writer = ResultWriter(out, args.format, write_header=not append)
+    store = HistoryStore(args.history) if args.history else None
+    started = time.monotonic()
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(analyze_archive, path) for path in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                writer.write(result)
+                if store is not None and not result["error"]:
+                    data = {key: value for key, value in result.items() if key not in ("file", "error")}
+                    store.add(data, "file:" + os.path.abspath(result["file"]), created=os.path.getmtime(result["file"]))
+                if result["error"]:
+                    failed += 1
+                rate = done / max(time.monotonic() - started, 1e-9)
+                print(
+                    f"[{done}/{len(pending)}] {rate:.1f} файл/с, ошибок: {failed} — {result['file']}",
+                    file=sys.stderr
+                )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if store is not None:
+            store.close()
+
+def run_history(args):
+    store = HistoryStore(args.db)
+    try:
+        if args.device:
+            keys = [args.device]
+        elif args.user is not None:
+            keys = [row["device_key"] for row in store.user_devices(args.user)]
+        else:
+            keys = [row["device_key"] for row in store.db.execute("SELECT DISTINCT device_key FROM reports")]
+
+        for key in keys:
+            rows = store.trend(key, args.limit, user_id=args.user)
+            if rows:
+                print(format_history(rows))
+                print()
+    finally:
+        store.close()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Бот и пакетный анализ Android Bug Report")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("bot", help="запустить Telegram-бота (по умолчанию)")
+
+    batch = commands.add_parser("batch", help="проанализировать каталог или маску ZIP-архивов")
+    batch.add_argument("source", help="каталог (поиск *.zip рекурсивно) или glob-маска")
+    batch.add_argument("-o", "--output", help="файл результатов (по умолчанию stdout)")
+    batch.add_argument("-f", "--format", choices=["jsonl", "csv"], default="jsonl")
+    batch.add_argument("-w", "--workers", type=int, default=PARSE_WORKERS)
+    batch.add_argument("--resume", action="store_true", help="пропустить файлы, уже записанные в --output")
+    batch.add_argument("--history", metavar="DB", help="сохранить результаты в базу истории устройств")
+
+    history = commands.add_parser("history", help="тренды батареи и отличия от прошлых отчётов")
+    history.add_argument("--db", default=HISTORY_DB or "history.sqlite3")
+    history.add_argument("--user", type=int, help="устройства пользователя Telegram")
+    history.add_argument("--device", help="ключ устройства: build|display_id")
+    history.add_argument("--limit", type=int, default=HISTORY_LIMIT)
+    return parser.parse_args(argv)
+
+# Приложение с обработчиками; используется и с run_polling, и в режиме webhook
+def build_application(token, concurrent_updates=None):
+    builder = Application.builder().token(token).post_init(start_parse_queue).post_shutdown(shutdown_parse_queue)
+    if concurrent_updates:
+        builder = builder.concurrent_updates(concurrent_updates)
+    app = builder.build()
     
     # Регистрация обработчиков
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL, handle_zip))
+    app.add_handler(CommandHandler("history", show_history))
+    # block=False: разбор не задерживает обработку остальных обновлений
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_zip, block=False))
     app.add_handler(CallbackQueryHandler(show_instruction, pattern='instruction'))
     app.add_handler(CallbackQueryHandler(back_to_main, pattern='back'))
-    
-    app.run_polling()
+    return app
+
+# Основная функция
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.command == "batch":
+        run_batch(args)
+        return
+    if args.command == "history":
+        run_history(args)
+        return
+
+    # Загрузка токена из файла
+    with open('token.txt') as f:
+        token = f.read().strip()
+
+    if METRICS_PORT:
+        bot_metrics.start_http_server(METRICS_PORT)
+    if MEMORY_PROFILE:
+        logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+        tracemalloc.start()
+
+    if WEBHOOK_PORT:
+        app = build_application(token, concurrent_updates=WEBHOOK_CONCURRENT_UPDATES)
+        server = bot_webhook.WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL, WEBHOOK_CONCURRENT_UPDATES)
+        server.add("phonestat", app, secret=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+        bot_webhook.run(server)
+        return
+
+    app = build_application(token)
+    bot_webhook.add_latency_probe(app, "phonestat", "polling")
+    app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()